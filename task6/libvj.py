@@ -24,15 +24,27 @@ SOFTWARE.
 
 #==============================================================================
 import abc
+import copy
+import hashlib
+import itertools
+import json
 import math
+import shutil
+import zlib
 
 import numpy as np
 
 import os
 import os.path
 
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import progressbar
 
+import scipy.sparse as sparse
+
 from skimage.transform import resize
 
 #==============================================================================
@@ -44,6 +56,98 @@ def normalize_image(image):
     else:
         return ((image - mean) / std)
 
+#==============================================================================
+# Набор изображений разного размера
+#
+# Пиксели всех изображений лежат подряд в одном плоском массиве, индекс хранит
+# для каждого изображения смещение и форму. Оба массива сохраняются в .npy и
+# при следующем запуске отображаются в память, изображения -- представления без копирования.
+
+class ImageStore:
+    def __init__(self, pixels, index):
+        '''
+        На входе:
+            pixels -- одномерный numpy массив пикселей всех изображений
+            index  -- двумерный numpy массив (N, 5): смещение, ndim и форма (до 3 осей)
+        '''
+        self.pixels = pixels
+        self.index = index
+    
+    @staticmethod
+    def from_images(images, path = None):
+        '''
+        Собирает набор из последовательности (например, генератора) изображений
+        
+        Если задан path, пиксели по мере поступления дописываются на диск (в памяти
+        одновременно только одно изображение), набор сохраняется как в save и
+        возвращается открытым через mmap
+        '''
+        if path is None:
+            parts, index = [], []
+            offset = 0
+            for image in images:
+                image = np.asarray(image)
+                index.append([offset, image.ndim] + list(image.shape) + [0] * (3 - image.ndim))
+                parts.append(image.ravel())
+                offset += image.size
+            
+            pixels = np.concatenate(parts) if parts else np.zeros(0, np.uint8)
+            return ImageStore(pixels, np.array(index, np.int64).reshape(-1, 5))
+        
+        # Сначала сырые пиксели во временный файл: их общее число станет известно только в конце
+        raw_file = path + '_pixels.raw'
+        index = []
+        offset = 0
+        dtype = None
+        with open(raw_file, 'wb') as raw:
+            for image in images:
+                if dtype is None:
+                    dtype = np.asarray(image).dtype
+                image = np.ascontiguousarray(image, dtype)
+                index.append([offset, image.ndim] + list(image.shape) + [0] * (3 - image.ndim))
+                raw.write(image.tobytes())
+                offset += image.size
+        
+        # Дописываем к ним заголовок .npy блоками
+        dtype = np.dtype(np.uint8) if dtype is None else dtype
+        with open(path + '_pixels.npy', 'wb') as out, open(raw_file, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(out, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                       'fortran_order': False,
+                                                       'shape': (offset,)})
+            shutil.copyfileobj(raw, out, 1 << 24)
+        os.remove(raw_file)
+        # индекс пишется последним
+        np.save(path + '_index.npy', np.array(index, np.int64).reshape(-1, 5))
+        return ImageStore.load(path)
+    
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(path + '_index.npy')
+    
+    def save(self, path):
+        '''
+        Сохраняет набор в path_pixels.npy и path_index.npy (индекс пишется последним)
+        '''
+        np.save(path + '_pixels.npy', self.pixels)
+        np.save(path + '_index.npy', self.index)
+    
+    @staticmethod
+    def load(path, mmap_mode = 'r'):
+        return ImageStore(np.load(path + '_pixels.npy', mmap_mode = mmap_mode),
+                          np.load(path + '_index.npy'))
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __getitem__(self, i):
+        offset, ndim = self.index[i, :2]
+        shape = tuple(self.index[i, 2 : 2 + ndim])
+        return self.pixels[offset : offset + int(np.prod(shape))].reshape(shape)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
 #==============================================================================
 # Интегральное изображение
 
@@ -82,15 +186,126 @@ class IntegralImage:
         
         return b22 - b12 - b21 + b11
 
+    @staticmethod
+    def from_integral(integral_image):
+        '''
+        Обертка над уже посчитанным интегральным изображением (без копирования)
+        '''
+        ret = IntegralImage.__new__(IntegralImage)
+        ret.integral_image = integral_image
+        return ret
+
 #==============================================================================
-def get_integral_imgs(imgs, img_file):
+# Пачка интегральных изображений
+#
+# Все N интегральных изображений лежат в одном непрерывном массиве (N, h+1, w+1),
+# строятся двумя векторными cumsum по всей пачке сразу.
+
+class IntegralImageStack:
+    def __init__(self, images, dtype = None):
+        '''
+        На входе:
+            images -- трехмерный numpy массив (N, h, w) или список изображений одного размера
+            dtype  -- тип элементов интегральных изображений (по умолчанию - тип изображений)
+        '''
+        images = np.asarray(images)
+        assert(images.ndim == 3)
+        n, h, w = images.shape
+        
+        if dtype is None:
+            # целочисленные изображения накапливаем в int64, чтобы не переполниться
+            dtype = images.dtype if images.dtype.kind == 'f' else np.int64
+        
+        ii = np.zeros((n, h + 1, w + 1), dtype)
+        np.cumsum(images, 1, dtype = dtype, out = ii[:, 1:, 1:])
+        np.cumsum(ii[:, 1:, 1:], 2, out = ii[:, 1:, 1:])
+        
+        self.integral_images = ii
     
-    if os.path.isfile(img_file):
-        return list(np.load(img_file))
-    else:
-        ret = [IntegralImage(im) for im in imgs]
-        np.save(img_file, np.array(ret))
+    @staticmethod
+    def from_integral(integral_images):
+        '''
+        Обертка над уже посчитанным массивом (N, h+1, w+1) (без копирования)
+        '''
+        ret = IntegralImageStack.__new__(IntegralImageStack)
+        ret.integral_images = integral_images
         return ret
+    
+    @property
+    def shape(self):
+        return self.integral_images.shape
+    
+    def __len__(self):
+        return len(self.integral_images)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # срез пачки -- тоже пачка (без копирования)
+            return IntegralImageStack.from_integral(self.integral_images[i])
+        return IntegralImage.from_integral(self.integral_images[i])
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def flat(self):
+        '''
+        Интегральные изображения, развернутые в строки: (N, (h+1)*(w+1)), без копирования
+        '''
+        return self.integral_images.reshape(len(self), -1)
+    
+    def sum(self, x1, y1, x2, y2):
+        '''
+        Сумма подмассива для всех изображений пачки
+        
+        На входе:
+            x1, y1 -- координаты левого нижнего угла прямоугольника запроса
+            x2, y2 -- координаты верхнего правого угла прямоугольника запроса
+            Координаты могут быть числами или numpy массивами одной формы S
+            
+        На выходе:
+            numpy массив (N,) + S, сумма подмассива [x1..x2, y1..y2] для каждого изображения
+        '''
+        x1, y1, x2, y2 = [np.asarray(c) for c in (x1, y1, x2, y2)]
+        assert(np.all(x1 <= x2))
+        assert(np.all(y1 <= y2))
+        
+        x2 = x2 + 1
+        y2 = y2 + 1
+        
+        ii = self.integral_images
+        
+        b11 = ii[:, x1, y1]
+        b12 = ii[:, x2, y1]
+        b21 = ii[:, x1, y2]
+        b22 = ii[:, x2, y2]
+        
+        return b22 - b12 - b21 + b11
+
+#==============================================================================
+def get_integral_imgs(imgs, img_file, mmap_mode = 'r'):
+    '''
+    Интегральные изображения с кешированием в файле img_file: один непрерывный
+    массив (N, h+1, w+1) float32 (int32 для целочисленных изображений)
+    
+    На выходе:
+        IntegralImageStack; кеш открывается через np.load(..., mmap_mode = mmap_mode),
+        IntegralImage для отдельных изображений создаются по требованию
+    '''
+    if os.path.isfile(img_file):
+        try:
+            return IntegralImageStack.from_integral(np.load(img_file, mmap_mode = mmap_mode))
+        except ValueError:
+            # старый кеш -- массив объектов IntegralImage, пересчитаем
+            pass
+    
+    imgs = np.asarray(imgs)
+    floating = imgs.dtype.kind == 'f'
+    dtype = np.float32 if floating else np.int32
+    # накапливаем с двойной точностью (и для float32 изображений), храним в компактном типе
+    ret = IntegralImageStack(imgs, np.float64 if floating else np.int64).integral_images.astype(dtype)
+    np.save(img_file, ret)
+    return IntegralImageStack.from_integral(ret)
 
 #==============================================================================
 # Признаки Хаара
@@ -112,6 +327,36 @@ class HaarFeature(object):
         '''
         pass
     
+    @abc.abstractmethod
+    def rects(self):
+        '''
+        Признак как взвешенная сумма прямоугольников
+        
+        На выходе:
+            список (weight, x1, y1, x2, y2), значение признака == sum(weight * sum(x1, y1, x2, y2))
+        '''
+        pass
+    
+    def corners(self):
+        '''
+        Признак как знаковая комбинация углов интегрального изображения
+        
+        На выходе:
+            словарь {(x, y): weight}, значение признака == sum(weight * integral_image[x, y])
+        '''
+        ret = {}
+        for weight, x1, y1, x2, y2 in self.rects():
+            for x, y, sign in ((x2 + 1, y2 + 1, 1), (x2 + 1, y1, -1), (x1, y2 + 1, -1), (x1, y1, 1)):
+                ret[(x, y)] = ret.get((x, y), 0.0) + sign * weight
+        return {k : v for k, v in ret.items() if v != 0}
+    
+    def geometry(self):
+        '''
+        На выходе:
+            (x, y, w, h) -- аргументы конструктора признака
+        '''
+        return self.x_s, self.y_s, self.x_e - self.x_s + 1, self.y_e - self.y_s + 1
+    
     def __repr__(self):
         return "Feature {}, {}, {}, {}".format(self.x_s, self.y_s, self.x_e, self.y_e)
 
@@ -137,6 +382,10 @@ class HaarFeatureVerticalTwoSegments(HaarFeature):
         s1 = integral_image.sum(self.x_s, self.y_s, self.x_e, self.y_m_1)
         s2 = integral_image.sum(self.x_s, self.y_m, self.x_e, self.y_e)
         return s1 - s2
+    
+    def rects(self):
+        return [(1.0,  self.x_s, self.y_s, self.x_e, self.y_m_1),
+                (-1.0, self.x_s, self.y_m, self.x_e, self.y_e)]
 
 #==============================================================================
 class HaarFeatureVerticalThreeSegments(HaarFeature):
@@ -160,6 +409,10 @@ class HaarFeatureVerticalThreeSegments(HaarFeature):
         s1 = integral_image.sum(self.x_s, self.y_s,  self.x_e, self.y_e)
         s2 = integral_image.sum(self.x_s, self.y_m1, self.x_e, self.y_m2)
         return s1 - 2.0 * s2
+    
+    def rects(self):
+        return [(1.0,  self.x_s, self.y_s,  self.x_e, self.y_e),
+                (-2.0, self.x_s, self.y_m1, self.x_e, self.y_m2)]
 
 #==============================================================================
 class HaarFeatureHorizontalTwoSegments(HaarFeature):
@@ -183,6 +436,10 @@ class HaarFeatureHorizontalTwoSegments(HaarFeature):
         s1 = integral_image.sum(self.x_m, self.y_s, self.x_e,   self.y_e)
         s2 = integral_image.sum(self.x_s, self.y_s, self.x_m_1, self.y_e)
         return s1 - s2
+    
+    def rects(self):
+        return [(1.0,  self.x_m, self.y_s, self.x_e,   self.y_e),
+                (-1.0, self.x_s, self.y_s, self.x_m_1, self.y_e)]
 
 #==============================================================================
 class HaarFeatureHorizontalThreeSegments(HaarFeature):
@@ -206,6 +463,10 @@ class HaarFeatureHorizontalThreeSegments(HaarFeature):
         s1 = integral_image.sum(self.x_s,  self.y_s,  self.x_e,  self.y_e)
         s2 = integral_image.sum(self.x_m1, self.y_s,  self.x_m2, self.y_e)
         return s1 - 2*s2
+    
+    def rects(self):
+        return [(1.0,  self.x_s,  self.y_s, self.x_e,  self.y_e),
+                (-2.0, self.x_m1, self.y_s, self.x_m2, self.y_e)]
 
 #==============================================================================
 class HaarFeatureFourSegments(HaarFeature):
@@ -234,7 +495,22 @@ class HaarFeatureFourSegments(HaarFeature):
         s3 = integral_image.sum(self.x_m, self.y_s, self.x_e,   self.y_m_1)
         
         return s1 - 2*s2 - 2*s3
+    
+    def rects(self):
+        return [(1.0,  self.x_s, self.y_s, self.x_e,   self.y_e  ),
+                (-2.0, self.x_s, self.y_m, self.x_m_1, self.y_e  ),
+                (-2.0, self.x_m, self.y_s, self.x_e,   self.y_m_1)]
        
+#==============================================================================
+# Все типы признаков; номер типа в этом списке используется в файле модели,
+# поэтому новые типы добавляются только в конец
+
+HAAR_FEATURE_TYPES = [HaarFeatureVerticalTwoSegments,
+                      HaarFeatureVerticalThreeSegments,
+                      HaarFeatureHorizontalTwoSegments,
+                      HaarFeatureHorizontalThreeSegments,
+                      HaarFeatureFourSegments]
+
 #==============================================================================
 # Вычислим все признаки на всех изображениях
 
@@ -244,6 +520,329 @@ def compute_features_for_image(integral_image, features):
         result[ind] = feature.compute_value(integral_image)
     return result
 
+#==============================================================================
+# Интегральные изображения кадра: обычное и от квадратов яркостей
+#
+# Строятся один раз на кадр, среднее и стандартное отклонение любого окна
+# получаются по восьми обращениям к ним.
+
+class FrameIntegrals:
+    def __init__(self, image):
+        image = np.asarray(image, np.float64)
+        self.shape = image.shape
+        self.integral    = IntegralImage(image).integral_image
+        self.integral_sq = IntegralImage(image * image).integral_image
+    
+    @staticmethod
+    def from_integrals(integral, integral_sq):
+        '''
+        Обертка над уже посчитанными интегральными изображениями (без копирования)
+        '''
+        ret = FrameIntegrals.__new__(FrameIntegrals)
+        ret.shape = (integral.shape[0] - 1, integral.shape[1] - 1)
+        ret.integral = integral
+        ret.integral_sq = integral_sq
+        return ret
+    
+    @staticmethod
+    def _window_sum(ii, x, xc, y, yc):
+        return ii[xc, yc] - ii[x, yc] - ii[xc, y] + ii[x, y]
+    
+    def window_stats(self, x, xc, y, yc):
+        '''
+        На входе:
+            x, xc, y, yc -- границы окна image[x:xc, y:yc] (числа или numpy массивы)
+            
+        На выходе:
+            mean, std -- среднее и стандартное отклонение яркости в окне
+        '''
+        n = (np.asarray(xc) - x) * (np.asarray(yc) - y)
+        mean = self._window_sum(self.integral, x, xc, y, yc) / n
+        var  = self._window_sum(self.integral_sq, x, xc, y, yc) / n - mean * mean
+        return mean, np.sqrt(np.maximum(var, 0.0))
+
+#==============================================================================
+# Признаки, масштабированные под окно заданного размера
+#
+# Вместо того, чтобы приводить каждое окно к img_sz x img_sz, углы признаков
+# масштабируются под размер окна, и признаки считаются прямо по интегральному
+# изображению кадра.
+
+class ScaledFeatures:
+    def __init__(self, features, img_sz, size):
+        '''
+        На входе:
+            features -- список признаков Хаара (для окна img_sz x img_sz)
+            img_sz   -- размер окна, на котором обучались признаки
+            size     -- размер окна в кадре
+        '''
+        k = float(size) / img_sz
+        
+        cx, cy, weights, starts = [], [], [], []
+        for feature in features:
+            corners = {}
+            for (x, y), weight in feature.corners().items():
+                x, y = int(math.floor(x * k + 0.5)), int(math.floor(y * k + 0.5))
+                corners[(x, y)] = corners.get((x, y), 0.0) + weight
+            starts.append(len(cx))
+            for (x, y), weight in corners.items():
+                cx.append(x)
+                cy.append(y)
+                weights.append(weight)
+        
+        self.size = size
+        self.cx = np.array(cx, np.intp)
+        self.cy = np.array(cy, np.intp)
+        self.weights = np.array(weights)
+        self.starts = np.array(starts + [len(cx)], np.intp)
+        # Значение признака на окне из единиц (коэффициент при среднем)
+        self.dc = np.add.reduceat(self.weights * self.cx * self.cy, self.starts[:-1])
+        # Во сколько раз площадь прямоугольников больше, чем в окне img_sz x img_sz
+        self.area_ratio = k * k
+    
+    def __len__(self):
+        return len(self.starts) - 1
+    
+    def value(self, integral, x, y, ind):
+        '''
+        Ненормированное значение признака ind для окна с левым верхним углом (x, y)
+        
+        На входе:
+            integral -- интегральное изображение кадра (numpy массив)
+        '''
+        a, b = self.starts[ind], self.starts[ind + 1]
+        return np.dot(integral[x + self.cx[a:b], y + self.cy[a:b]], self.weights[a:b])
+    
+    def values(self, integral, x, y):
+        '''
+        Ненормированные значения всех признаков для окон с левыми верхними углами (x, y)
+        
+        На входе:
+            integral -- интегральное изображение кадра (numpy массив)
+            x, y     -- одномерные numpy массивы координат окон
+            
+        На выходе:
+            двумерный numpy массив (len(x), n_features)
+        '''
+        # Одна выборка по развернутому интегральному изображению:
+        # смещение окна + смещения углов признаков
+        stride = integral.shape[1]
+        base = np.asarray(x) * stride + np.asarray(y)
+        corners = integral.reshape(-1)[base[:, None] + (self.cx * stride + self.cy)] * self.weights
+        return np.add.reduceat(corners, self.starts[:-1], axis = 1)
+    
+    def take(self, inds):
+        '''
+        Масштабированные признаки с номерами inds (в этом порядке)
+        '''
+        ranges = [np.arange(self.starts[i], self.starts[i + 1]) for i in inds]
+        lengths = [len(r) for r in ranges]
+        corners = np.concatenate(ranges) if ranges else np.zeros(0, np.intp)
+        
+        ret = ScaledFeatures.__new__(ScaledFeatures)
+        ret.size = self.size
+        ret.cx = self.cx[corners]
+        ret.cy = self.cy[corners]
+        ret.weights = self.weights[corners]
+        ret.starts = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+        ret.dc = self.dc[list(inds)]
+        ret.area_ratio = self.area_ratio
+        return ret
+    
+    def normalize(self, values, mean, std):
+        '''
+        Приводит значения признаков к значениям на нормированном окне img_sz x img_sz
+        '''
+        mean = np.asarray(mean)[..., None]
+        std  = np.asarray(std)[..., None]
+        scale = np.where(std == 0, 0.0, 1.0 / (np.where(std == 0, 1.0, std) * self.area_ratio))
+        return (values - mean * self.dc) * scale
+
+class ScaledWindowFeatures:
+    '''
+    Ленивый вектор нормированных признаков одного окна кадра
+    '''
+    def __init__(self, scaled_features, integral, x, y, mean, std):
+        self.scaled_features = scaled_features
+        self.integral = integral
+        self.x = x
+        self.y = y
+        self.mean = mean
+        self.scale = 0.0 if std == 0 else 1.0 / (std * scaled_features.area_ratio)
+        self.values = {}
+    
+    def __len__(self):
+        return len(self.scaled_features)
+    
+    def __getitem__(self, ind):
+        if ind not in self.values:
+            sf = self.scaled_features
+            value = sf.value(self.integral, self.x, self.y, ind)
+            self.values[ind] = (value - self.mean * sf.dc[ind]) * self.scale
+        return self.values[ind]
+
+#==============================================================================
+# Ленивый вектор признаков: признак считается при первом обращении
+
+class LazyFeatures:
+    def __init__(self, integral_image, features, offset = None, scale = 1.0):
+        '''
+        На входе:
+            integral_image -- IntegralImage
+            features       -- список признаков
+            offset, scale  -- значение признака ind равно (compute_value - offset[ind]) * scale
+        '''
+        self.integral_image = integral_image
+        self.features = features
+        self.offset = offset
+        self.scale = scale
+        self.values = {}
+    
+    def __len__(self):
+        return len(self.features)
+    
+    def __getitem__(self, ind):
+        if ind not in self.values:
+            value = self.features[ind].compute_value(self.integral_image)
+            if self.offset is not None:
+                value -= self.offset[ind]
+            self.values[ind] = value * self.scale
+        return self.values[ind]
+
+#==============================================================================
+# Все признаки сразу: разреженная матрица весов углов интегрального изображения
+#
+# Каждый признак -- знаковая комбинация углов интегрального изображения,
+# поэтому весь набор признаков -- это одна разреженная матрица
+# (n_features, (h+1)*(w+1)), а значения всех признаков для пачки изображений --
+# одно разреженное матричное умножение на развернутые интегральные изображения.
+
+class HaarFeatureOperator:
+    def __init__(self, features, img_sz):
+        '''
+        На входе:
+            features -- список признаков Хаара
+            img_sz   -- размер (квадратного) окна, на котором считаются признаки
+        '''
+        n = img_sz + 1
+        
+        rows, cols, vals = [], [], []
+        for ind, feature in enumerate(features):
+            for (x, y), weight in feature.corners().items():
+                rows.append(ind)
+                cols.append(x * n + y)
+                vals.append(weight)
+        
+        self.img_sz = img_sz
+        self.matrix = sparse.csr_matrix((vals, (rows, cols)), shape = (len(features), n * n))
+    
+    def __len__(self):
+        return self.matrix.shape[0]
+    
+    def compute(self, integral_images):
+        '''
+        На входе:
+            integral_images -- IntegralImageStack или numpy массив (N, img_sz+1, img_sz+1)
+            
+        На выходе:
+            двумерный numpy массив (N, n_features) значений признаков
+        '''
+        if isinstance(integral_images, IntegralImageStack):
+            flat = integral_images.flat()
+        else:
+            flat = np.asarray(integral_images).reshape(len(integral_images), -1)
+        
+        assert(flat.shape[1] == self.matrix.shape[1])
+        
+        return self.matrix.dot(flat.T).T
+
+#==============================================================================
+def _save_progress(path, header, done):
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, np.concatenate((header, done.astype(np.int64))))
+    os.replace(tmp_path, path)
+
+def compute_features_file(integral_images, operator, path, chunk_size = 256, bar = None):
+    '''
+    Значения признаков с записью по частям в float32 .npy файл, отображенный в память
+    
+    Пока расчет не закончен, рядом лежит path.progress.npy со списком посчитанных
+    частей; при повторном вызове посчитанные части пропускаются.
+    
+    На входе:
+        integral_images -- IntegralImageStack (или массив (N, h+1, w+1))
+        operator        -- HaarFeatureOperator
+        path            -- .npy файл для матрицы пример-признак
+        chunk_size      -- сколько изображений обрабатывать за раз
+        bar             -- progressbar для отображения хода работы
+        
+    На выходе:
+        матрица (N, n_features), открытая через mmap_mode = 'r'
+    '''
+    shape = (len(integral_images), len(operator))
+    n_chunks = (shape[0] + chunk_size - 1) // chunk_size
+    header = np.array([shape[0], shape[1], chunk_size], np.int64)
+    progress_file = path + '.progress.npy'
+    
+    done = None
+    if os.path.isfile(progress_file):
+        progress = np.load(progress_file)
+        if os.path.isfile(path) and np.array_equal(progress[:3], header):
+            done = progress[3:].astype(bool)
+    elif os.path.isfile(path):
+        # расчет был закончен
+        ret = np.load(path, mmap_mode = 'r')
+        if ret.shape == shape:
+            return ret
+    
+    if done is None:
+        # файл прогресса пишется раньше матрицы: матрица без него -- готовая
+        done = np.zeros(n_chunks, bool)
+        _save_progress(progress_file, header, done)
+        X = np.lib.format.open_memmap(path, 'w+', np.float32, shape)
+    else:
+        X = np.lib.format.open_memmap(path, 'r+')
+    
+    chunks = np.nonzero(~done)[0]
+    if bar is not None:
+        chunks = bar(chunks)
+    
+    for i in chunks:
+        start = i * chunk_size
+        X[start : start + chunk_size] = operator.compute(integral_images[start : start + chunk_size])
+        X.flush()
+        done[i] = True
+        _save_progress(progress_file, header, done)
+    
+    del X
+    os.remove(progress_file)
+    return np.load(path, mmap_mode = 'r')
+
+def concatenate_to_file(parts, path, block_rows = 4096):
+    '''
+    Записывает матрицы parts одну под другой в float32 .npy файл, отображенный
+    в память (части могут быть отображены в память и копируются блоками строк)
+    
+    Файл пишется через временный, поэтому существующий path всегда полный.
+    
+    На выходе:
+        итоговая матрица, открытая через mmap_mode = 'r'
+    '''
+    n_cols = parts[0].shape[1]
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    X = np.lib.format.open_memmap(tmp_path, 'w+', np.float32, (sum(len(part) for part in parts), n_cols))
+    offset = 0
+    for part in parts:
+        assert(part.shape[1] == n_cols)
+        for start in range(0, len(part), block_rows):
+            block = part[start : start + block_rows]
+            X[offset : offset + len(block)] = block
+            offset += len(block)
+    X.flush()
+    del X
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode = 'r')
+
 #==============================================================================
 # Базовый классификатор
 
@@ -327,52 +926,920 @@ class DecisionStump:
         return "Threshold: {}, polarity: {}".format(self.threshold, self.polarity)
 
 #==============================================================================
-# Бустинговый классификатор
+# Обучение решающих пней сразу по всем признакам
+#
+# То же, что DecisionStump.train, но для блока признаков целиком:
+# кумулятивные суммы весов считаются по строкам двумерных массивов.
 
-class BoostingClassifier:
-    def __init__(self, classifiers, weights, ftr_idxs, threshold = None):
-        self.classifiers = classifiers
-        self.weights = weights
-        self.ftr_idxs = ftr_idxs
-        self.threshold = sum(weights) / 2 if threshold is None else threshold
+def _stump_errors(yw, nw):
+    '''
+    На входе:
+        yw -- двумерный numpy массив (B, N), веса положительных примеров в порядке сортировки признака
+        nw -- двумерный numpy массив (B, N), веса отрицательных примеров в порядке сортировки признака
+        Массивы портятся!
+        
+    На выходе:
+        e_pos, e_neg -- ошибки пня с порогом X[i, n] для полярностей 1 и -1
+    '''
+    cyw = np.cumsum(yw, 1)
+    cnw = np.cumsum(nw, 1)
     
-    def classify(self, X, ret_qa = False):
-        '''
-        На входе:
-        X -- одномерный numpy вектор признаков
+    # polarity = -1: ошибаемся на положительных правее порога и на отрицательных до него включительно
+    e_neg = cyw[:, -1:] - cyw
+    e_neg += cnw
+    
+    # polarity = 1: ошибаемся на положительных левее порога и на отрицательных от него и правее
+    nw -= cnw
+    nw += cnw[:, -1:]
+    cyw -= yw
+    cyw += nw
+    
+    return cyw, e_neg
 
-        На выходе:
-        1, если ансамбль выдает значение больше threshold и 0 если меньше
-        '''
-        res = 0.0
-        for classifier, weight, ftr_idx in zip(self.classifiers, self.weights, self.ftr_idxs):
-            res += weight * classifier.classify(X[ftr_idx])
-            
-        ret_val = int(res > self.threshold)
-            
-        if ret_qa:
-            return ret_val, res/self.threshold
+def _best_stumps(X, indices, yw, nw):
+    '''
+    Лучший пень для каждой строки блока
+    
+    На входе:
+        X       -- двумерный numpy массив (B, N) отсортированных значений признаков
+        indices -- двумерный numpy массив (B, N) перестановок сортировки
+        yw, nw  -- одномерные numpy массивы y*w и (1-y)*w в исходном порядке
+        
+    На выходе:
+        error, threshold, polarity -- одномерные numpy массивы длины B
+    '''
+    rows = np.arange(len(X))
+    n = X.shape[1]
+    
+    e_pos, e_neg = _stump_errors(np.take(yw, indices), np.take(nw, indices))
+    
+    n_pos = np.argmin(e_pos, 1)
+    # DecisionStump.train ищет отрицательную полярность в перевернутом массиве,
+    # поэтому при равенстве ошибок берем самый правый порог
+    n_neg = n - 1 - np.argmin(e_neg[:, ::-1], 1)
+    
+    e_pos = e_pos[rows, n_pos]
+    e_neg = e_neg[rows, n_neg]
+    
+    is_pos = e_pos <= e_neg
+    
+    error     = np.where(is_pos, e_pos, e_neg)
+    threshold = np.where(is_pos, X[rows, n_pos], X[rows, n_neg])
+    polarity  = np.where(is_pos, 1, -1)
+    
+    return error, threshold, polarity
+
+def find_best_stump(X, indices, y, w, rows = None, block_size = 128, bar = None, keep = None):
+    '''
+    Функция находит лучший решающий пень среди признаков, обрабатывая их блоками
+    
+    На входе:
+        X          -- двумерный numpy массив, X[i] -- отсортированные значения признака i
+        indices    -- двумерный numpy массив, indices[i, j] == изначальный индекс элемента, j-го в порядке сортировки
+        y          -- одномерный numpy массив с классом объекта (0|1)
+        w          -- одномерный numpy массив весов
+        rows       -- номера признаков (range или numpy массив), по умолчанию все
+        block_size -- сколько признаков обрабатывать за раз (ограничивает память)
+        bar        -- progressbar для отображения хода работы
+        keep       -- bool маска примеров, по которым ищется порог (по умолчанию все)
+        
+    На выходе:
+        error, feature, threshold, polarity -- параметры лучшего пня
+        (ошибка -- по примерам из keep)
+    '''
+    if rows is None:
+        rows = range(0, len(X))
+    
+    yw = y * w
+    nw = (1 - y) * w
+    
+    best = (np.inf, -1, 0, 1)
+    
+    starts = range(0, len(rows), block_size)
+    if bar is not None:
+        starts = bar(starts)
+    
+    for start in starts:
+        r = rows[start : start + block_size]
+        if isinstance(r, range):
+            X_b, indices_b = X[r.start : r.stop], indices[r.start : r.stop]
         else:
-            return ret_val
+            X_b, indices_b = X[r], indices[r]
+        if keep is not None:
+            # в каждой строке остаются одни и те же примеры, порядок сортировки сохраняется
+            mask = keep[indices_b]
+            X_b = np.asarray(X_b)[mask].reshape(len(r), -1)
+            indices_b = np.asarray(indices_b)[mask].reshape(len(r), -1)
+        error, threshold, polarity = _best_stumps(X_b, indices_b, yw, nw)
+        i = np.argmin(error)
+        if error[i] < best[0]:
+            best = (error[i], int(r[i]), threshold[i], polarity[i])
+    
+    return best
 
 #==============================================================================
-# Обучение методом бустинга
-class ViolaJonesСlassifier(object):
-    def __init__(self, img_sz = 24, rounds = 200, eps = 1e-15):
-        self.img_sz = img_sz
-        self.rounds = rounds
-        self.eps    = eps
-        self.cls    = None #Классификатор
-        self.ftrs   = None #Набор фичей
+# Предсортировка признаков
+#
+# Для обучения пней нужны только порядок сортировки примеров по каждому признаку
+# и сами отсортированные значения (для порогов). В компактном режиме порядок
+# хранится в uint16/int32, а значения -- во float32, вместо int64 и float64.
+
+def presort_dtypes(n_examples, compact = False):
+    '''
+    На выходе:
+        типы (значений, перестановок) для матриц предсортировки
+    '''
+    if not compact:
+        return np.dtype(np.float64), np.dtype(np.intp)
+    if n_examples <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.float32), np.dtype(np.uint16)
+    return np.dtype(np.float32), np.dtype(np.int32)
+
+def open_presort(shape, compact = False, path = None):
+    '''
+    Выделяет матрицы предсортировки
+    
+    На входе:
+        shape   -- (n_features, n_examples)
+        compact -- использовать компактные типы
+        path    -- каталог, в котором матрицы будут отображены в память
+                   (values.npy, order.npy), по умолчанию -- в оперативной памяти
         
-    def train_classifier(classifier_type, X, y, w, indices):
-        classifier = classifier_type()
-        error = classifier.train(X, y, w, indices)
-        return error, classifier
+    На выходе:
+        values, order -- двумерные numpy массивы формы shape
+    '''
+    values_dtype, order_dtype = presort_dtypes(shape[1], compact)
+    if path is None:
+        return np.empty(shape, values_dtype), np.empty(shape, order_dtype)
+    
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    # прерванная перезапись не должна выглядеть готовой предсортировкой
+    clear_stamp(path, 'presort')
+    values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), 'w+', values_dtype, shape)
+    order  = np.lib.format.open_memmap(os.path.join(path, 'order.npy'),  'w+', order_dtype,  shape)
+    return values, order
 
-    def learn_best_classifier(classifier_type, X, y, w, indices):
+def data_stamp(X, *params, block_bytes = 1 << 24):
+    '''
+    Отпечаток матрицы пример-признак (размеры, тип и хеш всех элементов) и параметров,
+    с которыми по ней построены производные данные
+    
+    X хешируется блоками строк по ~block_bytes байт, поэтому может быть отображен в память
+    '''
+    n_examples, n_features = X.shape
+    digest = hashlib.sha1(np.dtype(X.dtype).str.encode())
+    rows = max(1, block_bytes // max(1, n_features * np.dtype(X.dtype).itemsize))
+    for start in range(0, n_examples, rows):
+        digest.update(np.ascontiguousarray(X[start : start + rows]).tobytes())
+    key = int(np.frombuffer(digest.digest()[:8], np.int64)[0])
+    return np.array([n_examples, n_features, key] + list(params), np.int64)
+
+def stamp_matches(path, name, stamp):
+    '''
+    Проверяет, что в каталоге path лежат готовые данные name, построенные по stamp
+    '''
+    if path is None:
+        return False
+    stamp_file = os.path.join(path, name + '_stamp.npy')
+    return os.path.isfile(stamp_file) and np.array_equal(np.load(stamp_file), stamp)
+
+def write_stamp(path, name, stamp):
+    '''
+    Отмечает данные name в каталоге path как готовые (пишется последним)
+    '''
+    if path is not None:
+        np.save(os.path.join(path, name + '_stamp.npy'), stamp)
+
+def clear_stamp(path, name):
+    '''
+    Снимает отметку готовности с данных name перед их перезаписью
+    '''
+    stamp_file = os.path.join(path, name + '_stamp.npy')
+    if os.path.isfile(stamp_file):
+        os.remove(stamp_file)
+
+def load_presort(path):
+    '''
+    Открывает готовые матрицы предсортировки из каталога path (без чтения в память)
+    '''
+    return (np.load(os.path.join(path, 'values.npy'), mmap_mode = 'r'),
+            np.load(os.path.join(path, 'order.npy'),  mmap_mode = 'r'))
+
+def presort_features(X, values, order, block_size = 1024, bar = None):
+    '''
+    Транспонирует и сортирует матрицу пример-признак блоками признаков,
+    не копируя X целиком
+    
+    На входе:
+        X      -- двумерный numpy массив, X[i,j] == значение признака j для примера i
+        values -- выход, values[j] -- отсортированные значения признака j
+        order  -- выход, order[j, k] == изначальный индекс примера, k-го в порядке сортировки признака j
+        bar    -- progressbar для отображения хода работы
+    '''
+    starts = range(0, X.shape[1], block_size)
+    if bar is not None:
+        starts = bar(starts)
+    
+    for start in starts:
+        block = np.asarray(X[:, start : start + block_size], np.float64).T
+        idx = np.argsort(block, 1)
+        order[start : start + len(block)]  = idx
+        values[start : start + len(block)] = np.take_along_axis(block, idx, 1)
+
+#==============================================================================
+# Обучение пней по гистограммам
+#
+# Каждый признак один раз квантуется в n_bins корзин по квантилям его значений.
+# На каждом раунде по признаку строятся взвешенные гистограммы положительных и
+# отрицательных примеров, и лучший порог ищется кумулятивной суммой по корзинам,
+# а не по всем примерам. Матрица перестановок при этом не нужна.
+
+class BinnedFeatures:
+    def __init__(self, codes, edges):
         '''
-        Функция находит лучший слабый классификатор
+        На входе:
+            codes -- двумерный numpy массив (n_features, n_examples), номер корзины примера:
+                     codes[i, j] == b, если edges[i, b-1] < X[j, i] <= edges[i, b]
+            edges -- двумерный numpy массив (n_features, n_bins), верхние границы корзин
+        '''
+        self.codes = codes
+        self.edges = edges
+    
+    @property
+    def n_bins(self):
+        return self.edges.shape[1]
+    
+    @staticmethod
+    def build(X, n_bins = 256, path = None, block_size = 1024, bar = None):
+        '''
+        Квантование матрицы пример-признак
+        
+        На входе:
+            X      -- двумерный numpy массив, X[i,j] == значение признака j для примера i
+            n_bins -- количество корзин (не больше 65536)
+            path   -- каталог, в котором матрицы будут отображены в память
+                      (codes.npy, edges.npy), по умолчанию -- в оперативной памяти
+        '''
+        n_examples, n_features = X.shape
+        codes_dtype = np.uint8 if n_bins <= 256 else np.uint16
+        if path is None:
+            codes = np.empty((n_features, n_examples), codes_dtype)
+            edges = np.empty((n_features, n_bins), np.float32)
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            # прерванная перезапись не должна выглядеть готовыми корзинами
+            clear_stamp(path, 'binned')
+            codes = np.lib.format.open_memmap(os.path.join(path, 'codes.npy'), 'w+', codes_dtype, (n_features, n_examples))
+            edges = np.lib.format.open_memmap(os.path.join(path, 'edges.npy'), 'w+', np.float32, (n_features, n_bins))
+        
+        # Границы корзин -- значения признака на квантилях (последняя -- максимум)
+        quantiles = np.ceil(np.arange(1, n_bins + 1) * n_examples / float(n_bins)).astype(int) - 1
+        
+        starts = range(0, n_features, block_size)
+        if bar is not None:
+            starts = bar(starts)
+        
+        for start in starts:
+            block = np.asarray(X[:, start : start + block_size], np.float64).T
+            block_edges = np.sort(block, 1)[:, quantiles]
+            # во float32 границы округляем вверх, чтобы максимум остался в последней корзине
+            rounded = block_edges.astype(np.float32)
+            block_edges = np.where(rounded < block_edges, np.nextafter(rounded, np.float32(np.inf)), rounded)
+            edges[start : start + len(block)] = block_edges
+            for i in range(len(block)):
+                codes[start + i] = np.searchsorted(block_edges[i].astype(np.float64), block[i], 'left')
+        
+        return BinnedFeatures(codes, edges)
+    
+    def _histograms(self, rows, yw, nw, keep):
+        if isinstance(rows, range):
+            codes = self.codes[rows.start : rows.stop]
+        else:
+            codes = self.codes[rows]
+        if keep is not None:
+            codes = np.asarray(codes)[:, keep]
+        codes = np.asarray(codes, np.intp)
+        n_rows, n_bins = len(codes), self.n_bins
+        flat = (codes + (np.arange(n_rows) * n_bins)[:, None]).ravel()
+        hp = np.bincount(flat, np.broadcast_to(yw, codes.shape).ravel(), n_rows * n_bins)
+        hn = np.bincount(flat, np.broadcast_to(nw, codes.shape).ravel(), n_rows * n_bins)
+        return hp.reshape(n_rows, n_bins), hn.reshape(n_rows, n_bins)
+    
+    def find_best_stump(self, y, w, block_size = 128, bar = None, keep = None, rows = None):
+        '''
+        На входе:
+            keep, rows -- подмножества примеров и признаков для поиска (см. find_best_stump)
+            
+        На выходе:
+            error, feature, split, polarity -- параметры лучшего пня; split == b означает
+            порог между корзинами b-1 и b
+        '''
+        if rows is None:
+            rows = range(0, len(self.codes))
+        
+        yw = y * w
+        nw = (1 - y) * w
+        if keep is not None:
+            yw, nw = yw[keep], nw[keep]
+        tp, tn = np.sum(yw), np.sum(nw)
+        
+        best = (np.inf, -1, 0, 1)
+        
+        starts = range(0, len(rows), block_size)
+        if bar is not None:
+            starts = bar(starts)
+        
+        for start in starts:
+            r = rows[start : start + block_size]
+            hp, hn = self._histograms(r, yw, nw, keep)
+            # веса примеров в корзинах левее порога b, b = 0..n_bins
+            cp = np.zeros((len(hp), self.n_bins + 1))
+            cn = np.zeros((len(hn), self.n_bins + 1))
+            np.cumsum(hp, 1, out = cp[:, 1:])
+            np.cumsum(hn, 1, out = cn[:, 1:])
+            
+            # polarity = 1: лицо правее порога, polarity = -1: левее
+            e_pos = cp + (tn - cn)
+            e_neg = (tp - cp) + cn
+            
+            b_pos = np.argmin(e_pos, 1)
+            b_neg = np.argmin(e_neg, 1)
+            k = np.arange(len(hp))
+            e_pos = e_pos[k, b_pos]
+            e_neg = e_neg[k, b_neg]
+            
+            error = np.minimum(e_pos, e_neg)
+            i = np.argmin(error)
+            if error[i] < best[0]:
+                if e_pos[i] <= e_neg[i]:
+                    best = (error[i], int(r[i]), b_pos[i], 1)
+                else:
+                    best = (error[i], int(r[i]), b_neg[i], -1)
+        
+        return best
+    
+    def threshold(self, feature, split, polarity):
+        '''
+        Порог DecisionStump, который на обучающих примерах дает то же, что разбиение
+        по корзинам (DecisionStump принимает polarity * x >= polarity * threshold)
+        '''
+        if split == 0:
+            return -np.inf
+        edge = float(self.edges[feature, split - 1])
+        return float(np.nextafter(edge, np.inf)) if polarity == 1 else edge
+    
+    def learn(self, y, w, block_size = 128, keep = None, rows = None):
+        '''
+        То же, что ViolaJonesСlassifier.learn_best_stump, но по гистограммам
+        '''
+        error, i, split, polarity = self.find_best_stump(y, w, block_size, progressbar.ProgressBar(), keep, rows)
+        
+        best_classifier = DecisionStump(self.threshold(i, split, polarity), int(polarity))
+        
+        codes = np.asarray(self.codes[i])
+        predictions = (codes >= split) if polarity == 1 else (codes < split)
+        
+        return best_classifier, error, i, predictions.astype(float)
+
+#==============================================================================
+# Параллельный поиск лучшего пня
+#
+# Матрицы отсортированных признаков и перестановок кладутся в разделяемую память
+# один раз на fit, каждый процесс ищет лучший пень на своем диапазоне признаков
+# для текущего вектора весов и возвращает только (error, feature, threshold, polarity).
+
+# Массивы, подключенные к разделяемой памяти в процессе-воркере
+_stump_worker_arrays = {}
+
+def _init_stump_worker(specs):
+    for key, (name, shape, dtype) in specs.items():
+        shm = SharedMemory(name = name)
+        _stump_worker_arrays[key] = (shm, np.ndarray(shape, dtype, buffer = shm.buf))
+
+def _search_stump_shard(args):
+    rows, y, w, block_size, keep = args
+    X       = _stump_worker_arrays['X'][1]
+    indices = _stump_worker_arrays['indices'][1]
+    return find_best_stump(X, indices, y, w, rows, block_size, keep = keep)
+
+class ParallelStumpSearch:
+    def __init__(self, shape, dtype, n_jobs, block_size = 128, n_shards = None, indices_dtype = np.intp):
+        '''
+        На входе:
+            shape      -- форма матрицы признак-примеры (n_features, n_examples)
+            dtype      -- тип значений признаков
+            indices_dtype -- тип перестановок
+            n_jobs     -- количество процессов
+            block_size -- сколько признаков обрабатывает процесс за раз
+            n_shards   -- на сколько диапазонов разбить признаки (по умолчанию 4 * n_jobs)
+            
+        Массивы self.X и self.indices лежат в разделяемой памяти,
+        их нужно заполнить до первого вызова learn.
+        '''
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+        
+        self._shms = {}
+        self._specs = {}
+        for key, dt in (('X', np.dtype(dtype)), ('indices', np.dtype(indices_dtype))):
+            shm = SharedMemory(create = True, size = max(1, int(np.prod(shape)) * dt.itemsize))
+            self._shms[key] = shm
+            self._specs[key] = (shm.name, shape, dt)
+        
+        self.X       = np.ndarray(shape, self._specs['X'][2],       buffer = self._shms['X'].buf)
+        self.indices = np.ndarray(shape, self._specs['indices'][2], buffer = self._shms['indices'].buf)
+        
+        if n_shards is None:
+            n_shards = 4 * n_jobs
+        n_features = shape[0]
+        bounds = np.linspace(0, n_features, min(n_shards, n_features) + 1).astype(int)
+        self.shards = [range(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+        
+        self._pool = None
+    
+    def learn(self, y, w, keep = None, rows = None):
+        '''
+        То же, что ViolaJonesСlassifier.learn_best_stump(self.X, y, w, self.indices, keep = keep, rows = rows)
+        '''
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.n_jobs, _init_stump_worker, (self._specs,))
+        
+        if rows is None:
+            shards = self.shards
+        else:
+            shards = [rows[(rows >= shard.start) & (rows < shard.stop)] for shard in self.shards]
+            shards = [shard for shard in shards if len(shard)]
+        tasks = [(shard, y, w, self.block_size, keep) for shard in shards]
+        
+        best = (np.inf, -1, 0, 1)
+        bar = progressbar.ProgressBar(maxval = len(tasks))
+        # imap сохраняет порядок диапазонов, поэтому при равных ошибках,
+        # как и в последовательном поиске, выигрывает признак с меньшим индексом
+        for res in bar(self._pool.imap(_search_stump_shard, tasks)):
+            if res[0] < best[0]:
+                best = res
+        
+        error, i, threshold, polarity = best
+        
+        best_classifier = DecisionStump(float(threshold), int(polarity))
+        
+        predictions = np.zeros(len(y))
+        predictions[self.indices[i]] = best_classifier.classify(self.X[i])
+        
+        return best_classifier, error, i, predictions
+    
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        
+        self.X = self.indices = None
+        for shm in self._shms.values():
+            shm.close()
+            shm.unlink()
+        self._shms = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+#==============================================================================
+# Бустинговый классификатор
+
+class BoostingClassifier:
+    def __init__(self, classifiers, weights, ftr_idxs, threshold = None):
+        self.classifiers = classifiers
+        self.weights = weights
+        self.ftr_idxs = ftr_idxs
+        self.threshold = sum(weights) / 2 if threshold is None else threshold
+    
+    def classify(self, X, ret_qa = False):
+        '''
+        На входе:
+        X -- одномерный numpy вектор признаков
+
+        На выходе:
+        1, если ансамбль выдает значение больше threshold и 0 если меньше
+        '''
+        res = 0.0
+        for classifier, weight, ftr_idx in zip(self.classifiers, self.weights, self.ftr_idxs):
+            res += weight * classifier.classify(X[ftr_idx])
+            
+        ret_val = int(res > self.threshold)
+            
+        if ret_qa:
+            return ret_val, res/self.threshold
+        else:
+            return ret_val
+    
+    def compile(self):
+        '''
+        На выходе:
+        CompiledBoostingClassifier с теми же слабыми классификаторами и порогом
+        '''
+        return CompiledBoostingClassifier([c.threshold for c in self.classifiers],
+                                          [c.polarity for c in self.classifiers],
+                                          self.weights, self.ftr_idxs, self.threshold)
+    
+    def score_batch(self, F, ftr_idxs = None):
+        return self.compile().score_batch(F, ftr_idxs)
+    
+    def classify_batch(self, F, ret_qa = False):
+        return self.compile().classify_batch(F, ret_qa)
+
+#==============================================================================
+# Бустинговый классификатор, хранящий пни в параллельных numpy массивах
+#
+# В режиме раннего отказа (soft cascade) задан порог rejection[t] на частичную
+# сумму первых t + 1 слабых классификаторов: окно, у которого частичная сумма
+# опустилась ниже порога, отвергается, не досчитывая остальные признаки.
+
+class CompiledBoostingClassifier:
+    def __init__(self, thresholds, polarities, alphas, ftr_idxs, threshold = None, rejection = None):
+        self.thresholds = np.asarray(thresholds, np.float64)
+        self.polarities = np.asarray(polarities, np.float64)
+        self.alphas     = np.asarray(alphas,     np.float64)
+        self.ftr_idxs   = ftr_idxs
+        self.threshold  = np.sum(self.alphas) / 2 if threshold is None else threshold
+        self.rejection  = None if rejection is None else np.asarray(rejection, np.float64)
+    
+    @property
+    def ftr_idxs(self):
+        return self._ftr_idxs
+    
+    @ftr_idxs.setter
+    def ftr_idxs(self, ftr_idxs):
+        self._ftr_idxs = np.asarray(ftr_idxs, np.intp)
+    
+    # Совместимость с BoostingClassifier
+    @property
+    def weights(self):
+        return self.alphas
+    
+    def __len__(self):
+        return len(self.alphas)
+    
+    def compile(self):
+        return self
+    
+    def soft_cascade(self, F_pos):
+        '''
+        Классификатор с ранним отказом: слабые классификаторы упорядочиваются по убыванию
+        веса, порог отказа на каждой позиции -- минимальная частичная сумма среди
+        положительных примеров, принятых классификатором (но не больше threshold).
+        Решение для окон, не отвергнутых досрочно, не меняется. Вызываем после calibrate.
+        
+        На входе:
+        F_pos -- двумерный numpy массив значений признаков положительных примеров
+        '''
+        if len(self) == 0:
+            # пустой классификатор (бустинг остановился на первом раунде) -- отказывать не по чему
+            return self
+        
+        order = np.argsort(-self.alphas, kind = 'stable')
+        ret = CompiledBoostingClassifier(self.thresholds[order], self.polarities[order],
+                                         self.alphas[order], self.ftr_idxs[order], self.threshold)
+        
+        F = np.asarray(F_pos)[:, ret.ftr_idxs]
+        partial = np.cumsum((ret.polarities * F >= ret.polarities * ret.thresholds) * ret.alphas, 1)
+        accepted = partial[:, -1] > ret.threshold
+        if np.any(accepted):
+            rejection = np.min(partial[accepted], 0)
+        else:
+            rejection = np.full(len(ret), -np.inf)
+        ret.rejection = np.minimum(rejection, ret.threshold)
+        return ret
+    
+    def blocks(self):
+        '''
+        Границы [start, stop) блоков слабых классификаторов, после которых проверяются
+        пороги отказа: 1, 1, 2, 4, 8, ... (без порогов -- один блок)
+        '''
+        n = len(self)
+        if self.rejection is None:
+            return [(0, n)]
+        bounds = [0]
+        while bounds[-1] < n:
+            bounds.append(min(n, max(1, 2 * bounds[-1])))
+        return list(zip(bounds[:-1], bounds[1:]))
+    
+    def score_block(self, F, start, stop, res):
+        '''
+        На входе:
+        F      -- двумерный numpy массив (n_windows, stop - start) значений признаков
+                  слабых классификаторов start..stop-1
+        res    -- частичные суммы окон до позиции start
+        
+        На выходе:
+        res      -- частичные суммы до stop (у отвергнутых окон -- на момент отказа)
+        rejected -- bool массив, окно отвергнуто внутри блока
+        '''
+        p, t, a = self.polarities[start:stop], self.thresholds[start:stop], self.alphas[start:stop]
+        votes = p * F >= p * t
+        if self.rejection is None:
+            return res + np.dot(votes, a), np.zeros(len(res), bool)
+        
+        partial = res[:, None] + np.cumsum(votes * a, 1)
+        below = partial < self.rejection[start:stop]
+        rejected = np.any(below, 1)
+        last = np.where(rejected, np.argmax(below, 1), stop - start - 1)
+        return partial[np.arange(len(res)), last], rejected
+    
+    def score_batch(self, F, ftr_idxs = None):
+        '''
+        На входе:
+        F -- двумерный numpy массив (n_windows, n_features) значений признаков
+        ftr_idxs -- номера столбцов F для слабых классификаторов (по умолчанию self.ftr_idxs)
+        
+        На выходе:
+        одномерный numpy массив взвешенных сумм слабых классификаторов
+        (в режиме раннего отказа у отвергнутых окон -- частичные суммы, меньшие threshold)
+        '''
+        if ftr_idxs is None:
+            ftr_idxs = self.ftr_idxs
+        ftr_idxs = np.asarray(ftr_idxs, np.intp)
+        F = np.asarray(F)
+        if self.rejection is None:
+            F = F[:, ftr_idxs]
+            return np.dot(self.polarities * F >= self.polarities * self.thresholds, self.alphas)
+        
+        res = np.zeros(len(F))
+        alive = np.arange(len(F))
+        for start, stop in self.blocks():
+            if len(alive) == 0:
+                break
+            res[alive], rejected = self.score_block(F[alive[:, None], ftr_idxs[start:stop]],
+                                                    start, stop, res[alive])
+            alive = alive[~rejected]
+        return res
+    
+    def classify_batch(self, F, ret_qa = False):
+        '''
+        На выходе:
+        одномерный numpy массив: 1, если ансамбль выдает значение больше threshold и 0 если меньше
+        qa -- (если ret_qa) отношение суммы к порогу
+        '''
+        res = self.score_batch(F)
+        ret_val = (res > self.threshold).astype(int)
+        if ret_qa:
+            return ret_val, res / self.threshold
+        else:
+            return ret_val
+    
+    def classify(self, X, ret_qa = False):
+        '''
+        На входе:
+        X -- одномерный numpy вектор признаков (или объект с ленивым X[i])
+        '''
+        if self.rejection is not None:
+            # признаки считаем по одному, пока окно не отвергнуто
+            res = 0.0
+            for i, ftr_idx in enumerate(self.ftr_idxs):
+                if self.polarities[i] * X[ftr_idx] >= self.polarities[i] * self.thresholds[i]:
+                    res += self.alphas[i]
+                if res < self.rejection[i]:
+                    break
+        elif isinstance(X, np.ndarray):
+            x = X[self.ftr_idxs]
+            res = np.dot(self.polarities * x >= self.polarities * self.thresholds, self.alphas)
+        else:
+            x = np.array([X[i] for i in self.ftr_idxs])
+            res = np.dot(self.polarities * x >= self.polarities * self.thresholds, self.alphas)
+        
+        ret_val = int(res > self.threshold)
+        
+        if ret_qa:
+            return ret_val, res/self.threshold
+        else:
+            return ret_val
+
+#==============================================================================
+# Каскад бустинговых классификаторов
+#
+# Окно отвергается, как только его отвергла одна из ступеней, поэтому
+# большинство окон без лиц стоит лишь нескольких признаков.
+
+class CascadeClassifier:
+    def __init__(self, stages):
+        self.stages = stages
+    
+    @property
+    def ftr_idxs(self):
+        return [i for stage in self.stages for i in stage.ftr_idxs]
+    
+    @ftr_idxs.setter
+    def ftr_idxs(self, ftr_idxs):
+        # Раскладываем индексы признаков обратно по ступеням
+        start = 0
+        for stage in self.stages:
+            stop = start + len(stage.ftr_idxs)
+            stage.ftr_idxs = list(ftr_idxs[start:stop])
+            start = stop
+    
+    def classify(self, X, ret_qa = False):
+        '''
+        На входе:
+        X -- вектор признаков (numpy массив или объект с ленивым X[i])
+        
+        На выходе:
+        1, если все ступени приняли окно, 0 иначе
+        qa -- качество последней вычисленной ступени
+        '''
+        ret_val, qa = 1, 1.0
+        for stage in self.stages:
+            ret_val, qa = stage.classify(X, ret_qa = True)
+            if not ret_val:
+                break
+        
+        if ret_qa:
+            return ret_val, qa
+        else:
+            return ret_val
+    
+    def compile(self):
+        return CascadeClassifier([stage.compile() for stage in self.stages])
+    
+    def classify_batch(self, F, ret_qa = False):
+        '''
+        На входе:
+        F -- двумерный numpy массив (n_windows, n_features) значений признаков
+        
+        Каждая ступень считается только для строк, принятых предыдущими ступенями
+        '''
+        ret_val = np.ones(len(F), int)
+        qa = np.ones(len(F))
+        alive = np.arange(len(F))
+        for stage in self.stages:
+            if len(alive) == 0:
+                break
+            passed, qa[alive] = stage.classify_batch(F[alive], ret_qa = True)
+            ret_val[alive] = passed
+            alive = alive[passed == 1]
+        
+        if ret_qa:
+            return ret_val, qa
+        else:
+            return ret_val
+
+#==============================================================================
+# Параллельный поиск лиц в процессах
+#
+# Интегральные изображения кадра кладутся в разделяемую память, классификатор
+# передается каждому процессу один раз при запуске.
+
+_detect_worker = {}
+
+def _init_detect_worker(classifier, specs):
+    arrays = []
+    for name, shape, dtype in specs:
+        shm = SharedMemory(name = name)
+        arrays.append((shm, np.ndarray(shape, dtype, buffer = shm.buf)))
+    _detect_worker['classifier'] = classifier
+    _detect_worker['shms'] = [shm for shm, _ in arrays]
+    _detect_worker['frame'] = FrameIntegrals.from_integrals(arrays[0][1], arrays[1][1])
+
+def _detect_tile_job(args):
+    step, job = args
+    return _detect_worker['classifier'].detect_tile(_detect_worker['frame'], job[1], step, *job[2:])
+
+def _detect_in_processes(classifier, frame, step, jobs, n_jobs):
+    shms, specs = [], []
+    try:
+        for arr in (frame.integral, frame.integral_sq):
+            shm = SharedMemory(create = True, size = arr.nbytes)
+            np.ndarray(arr.shape, arr.dtype, buffer = shm.buf)[:] = arr
+            shms.append(shm)
+            specs.append((shm.name, arr.shape, arr.dtype))
+        with ProcessPoolExecutor(n_jobs, initializer = _init_detect_worker,
+                                 initargs = (classifier, specs)) as pool:
+            # map возвращает результаты в порядке заданий
+            for res in pool.map(_detect_tile_job, [(step, job) for job in jobs]):
+                yield res
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+#==============================================================================
+# Подавление немаксимумов и группировка найденных рамок
+#
+# Рамки -- двумерный numpy массив строк (x, y, xc, yc, qa), как в результатах detect.
+
+def box_iou(boxes, others):
+    '''
+    На входе:
+        boxes, others -- двумерные numpy массивы рамок (n, >=4) и (m, >=4)
+        
+    На выходе:
+        матрица (n, m) отношений площади пересечения к площади объединения
+    '''
+    boxes  = np.asarray(boxes,  np.float64)[:, None, :4]
+    others = np.asarray(others, np.float64)[None, :, :4]
+    
+    dx = np.minimum(boxes[..., 2], others[..., 2]) - np.maximum(boxes[..., 0], others[..., 0])
+    dy = np.minimum(boxes[..., 3], others[..., 3]) - np.maximum(boxes[..., 1], others[..., 1])
+    inter = np.maximum(dx, 0) * np.maximum(dy, 0)
+    
+    area1 = (boxes[..., 2]  - boxes[..., 0])  * (boxes[..., 3]  - boxes[..., 1])
+    area2 = (others[..., 2] - others[..., 0]) * (others[..., 3] - others[..., 1])
+    union = area1 + area2 - inter
+    
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+def non_max_suppression(dets, iou_thr = 0.3):
+    '''
+    На входе:
+        dets    -- рамки (x, y, xc, yc, qa)
+        iou_thr -- рамки, перекрывающиеся с более уверенной больше чем на iou_thr, выбрасываются
+        
+    На выходе:
+        индексы оставленных рамок в порядке убывания qa
+    '''
+    dets = np.asarray(dets, np.float64).reshape(-1, 5)
+    order = np.argsort(-dets[:, 4], kind = 'stable')
+    
+    # IoU считаем построчно и только с еще не выброшенными рамками,
+    # чтобы не строить матрицу n x n
+    alive = order
+    keep = []
+    while len(alive):
+        i, alive = alive[0], alive[1:]
+        keep.append(i)
+        alive = alive[box_iou(dets[i : i + 1], dets[alive])[0] <= iou_thr]
+    return np.array(keep, np.intp)
+
+def group_detections(dets, iou_thr = 0.3, min_neighbors = 3):
+    '''
+    Группировка рамок вокруг самых уверенных: каждая группа -- рамка и все еще не
+    сгруппированные рамки, перекрывающиеся с ней больше чем на iou_thr
+    
+    На входе:
+        dets          -- рамки (x, y, xc, yc, qa)
+        iou_thr       -- порог перекрытия
+        min_neighbors -- группы меньшего размера выбрасываются
+        
+    На выходе:
+        список рамок (x, y, xc, yc, qa): координаты усреднены по группе с весами qa,
+        qa -- максимальное в группе
+    '''
+    dets = np.asarray(dets, np.float64).reshape(-1, 5)
+    order = np.argsort(-dets[:, 4], kind = 'stable')
+    dets = dets[order]
+    
+    # IoU считаем построчно и только с еще не сгруппированными рамками,
+    # чтобы не строить матрицу n x n
+    free = np.arange(len(dets))
+    ret = []
+    while len(free):
+        i = free[0]
+        in_group = box_iou(dets[i : i + 1], dets[free])[0] > iou_thr
+        in_group[0] = True
+        group, free = free[in_group], free[~in_group]
+        if len(group) < min_neighbors:
+            continue
+        
+        weights = np.maximum(dets[group, 4], 1e-12)
+        box = np.round(np.dot(weights, dets[group, :4]) / np.sum(weights)).astype(int)
+        ret.append((int(box[0]), int(box[1]), int(box[2]), int(box[3]), float(dets[i, 4])))
+    return ret
+
+#==============================================================================
+# Обучение методом бустинга
+class ViolaJonesСlassifier(object):
+    def __init__(self, img_sz = 24, rounds = 200, eps = 1e-15, block_size = 128, n_jobs = 1,
+                 compact = False, presort_dir = None, trainer = 'sorted', n_bins = 256,
+                 trim_weight = 0.0, feature_fraction = 1.0, random_state = None,
+                 checkpoint_dir = None, checkpoint_every = 10):
+        self.img_sz = img_sz
+        self.rounds = rounds
+        self.eps    = eps
+        self.block_size = block_size #Сколько признаков обрабатывать за раз при поиске пня
+        self.n_jobs = n_jobs         #Количество процессов для поиска пня
+        self.compact = compact       #Хранить предсортировку в uint16/int32 + float32
+        self.presort_dir = presort_dir #Каталог для отображения предсортировки в память (по умолчанию checkpoint_dir/presort)
+        self.trainer = trainer       #'sorted' -- точный поиск порога, 'histogram' -- по n_bins корзинам
+        self.n_bins = n_bins
+        self.trim_weight = trim_weight           #Доля суммарного веса, которую можно не учитывать при поиске пня
+        self.feature_fraction = feature_fraction #Доля признаков, просматриваемых на каждом раунде
+        self.random_state = random_state
+        self.checkpoint_dir = checkpoint_dir     #Каталог для контрольных точек fit
+        self.checkpoint_every = checkpoint_every #Период контрольных точек (в раундах)
+        self.cls    = None #Классификатор
+        self.ftrs   = None #Набор фичей
+        
+    def train_classifier(classifier_type, X, y, w, indices):
+        classifier = classifier_type()
+        error = classifier.train(X, y, w, indices)
+        return error, classifier
+
+    def learn_best_classifier(classifier_type, X, y, w, indices):
+        '''
+        Функция находит лучший слабый классификатор
         
         На входе:
         classifier_type -- класс классификатора (DecisionStump в нашем случае)
@@ -419,67 +1886,305 @@ class ViolaJonesСlassifier(object):
             predictions[indices[best_feature_ind][j]] = best_classifier.classify(X[best_feature_ind][j])
         
         return best_classifier, best_error, best_feature_ind, predictions
+    
+    def learn_best_stump(X, y, w, indices, block_size = 128, keep = None, rows = None):
+        '''
+        Векторизованный аналог learn_best_classifier(DecisionStump, ...):
+        пни обучаются сразу по блоку из block_size признаков
+        
+        keep, rows -- подмножества примеров и признаков для поиска (см. find_best_stump)
+        
+        На выходе:
+        best_classifier, best_error, best_feature_ind, predictions -- как у learn_best_classifier
+        '''
+        error, i, threshold, polarity = find_best_stump(X, indices, y, w, rows, block_size,
+                                                        progressbar.ProgressBar(), keep)
+        
+        best_classifier = DecisionStump(float(threshold), int(polarity))
+        
+        # вернем также предсказания лучшего классификатора
+        predictions = np.zeros(len(y))
+        predictions[indices[i]] = best_classifier.classify(X[i])
+        
+        return best_classifier, error, i, predictions
             
-    def fit(self, X, y):
+    def presort_path(self):
+        '''
+        Каталог для предсортировки/корзин: presort_dir, а если он не задан --
+        подкаталог presort в checkpoint_dir (чтобы возобновленное обучение не
+        сортировало X заново); None -- держать в памяти
+        '''
+        if self.presort_dir is not None:
+            return self.presort_dir
+        if self.checkpoint_dir is not None:
+            return os.path.join(self.checkpoint_dir, 'presort')
+        return None
+    
+    def boost(self, X, y, state = None, stamp = None):
         '''
+        Генератор раундов бустинга
+        
         На входе:
             X -- двумерный numpy массив, X[i,j] == значение признака j для примера i
             y -- одномерный numpy массив с классом объекта (0|1)
-            rounds -- максимальное количество раундов обучения
-            eps -- критерий останова (алгоритм останавливается, если новый классификатор имеет ошибку меньше eps)
-
-        На выходе:
-            классификатор типа BoostingClassifier
+            state -- словарь состояния: 'round' (число пройденных раундов), 'w' (веса
+                     примеров), 'rng'; если задан, обучение продолжается с него, и он
+                     обновляется после каждого раунда
+            stamp -- data_stamp(X), если уже посчитан (чтобы не хешировать X повторно)
+            
+        На выходе (на каждом раунде):
+            weak_classifier, alpha, ftr_idx, predictions -- новый слабый классификатор, его вес,
+            индекс его признака и его предсказания на X
         '''
-        # Транспонируем матрицу пример-признак к матрицу признак-примеры
-        print('Transpose X...')
-        X_t = X.copy().T
-        indices = np.zeros(X_t.shape).astype(int)
-        print('Done!\nSort X[i]...')
-        # Предсортируем каждый признак, но сохраним соответствие между индексами
-        # в массиве indices для каждого прзинака
-        bar = progressbar.ProgressBar()
-        for index in bar(range(0, len(X_t))):
-            indices[index] = X_t[index].argsort()
-            X_t[index].sort()
+        if state is not None and state.get('round', 0) >= self.rounds:
+            # все раунды уже пройдены (например, восстановлены из контрольной точки)
+            return
+        
+        search = None
+        presort_dir = self.presort_path()
+        if presort_dir is not None and stamp is None:
+            # отпечаток нужен только для проверки готовых данных на диске
+            stamp = data_stamp(X)
+        if self.trainer == 'histogram':
+            # Квантуем признаки, предсортировка не нужна
+            print('Bin X[i]...')
+            binned_stamp = None if stamp is None else np.append(stamp, self.n_bins)
+            if stamp_matches(presort_dir, 'binned', binned_stamp):
+                binned = BinnedFeatures(np.load(os.path.join(presort_dir, 'codes.npy'), mmap_mode = 'r'),
+                                        np.load(os.path.join(presort_dir, 'edges.npy'), mmap_mode = 'r'))
+            else:
+                binned = BinnedFeatures.build(X, self.n_bins, presort_dir, bar = progressbar.ProgressBar())
+                write_stamp(presort_dir, 'binned', binned_stamp)
+            learn = lambda y, w, keep, rows: binned.learn(y, w, self.block_size, keep, rows)
+        else:
+            # Транспонируем матрицу пример-признак к матрицу признак-примеры
+            print('Transpose X...')
+            shape = X.shape[::-1]
+            presort_stamp = None if stamp is None else np.append(stamp, self.compact)
+            if stamp_matches(presort_dir, 'presort', presort_stamp):
+                # Предсортировка уже лежит на диске (например, после прерванного обучения)
+                print('Done!\nLoad presorted X[i]...')
+                X_t, indices = load_presort(presort_dir)
+            elif self.n_jobs > 1 and presort_dir is None:
+                # Сортируем сразу в разделяемую память
+                X_t, indices = None, None
+            else:
+                X_t, indices = open_presort(shape, self.compact, presort_dir)
+                print('Done!\nSort X[i]...')
+                # Предсортируем каждый признак, но сохраним соответствие между индексами
+                # в массиве indices для каждого прзинака
+                presort_features(X, X_t, indices, bar = progressbar.ProgressBar())
+                write_stamp(presort_dir, 'presort', presort_stamp)
+            
+            if self.n_jobs > 1:
+                # X_t и indices должны лежать в разделяемой памяти
+                values_dtype, order_dtype = presort_dtypes(shape[1], self.compact)
+                search = ParallelStumpSearch(shape, values_dtype, self.n_jobs, self.block_size,
+                                             indices_dtype = order_dtype)
+                if X_t is None:
+                    print('Done!\nSort X[i]...')
+                    presort_features(X, search.X, search.indices, bar = progressbar.ProgressBar())
+                else:
+                    search.X[...] = X_t
+                    search.indices[...] = indices
+                learn = search.learn
+            else:
+                learn = lambda y, w, keep, rows: ViolaJonesСlassifier.learn_best_stump(X_t, y, w, indices, self.block_size, keep, rows)
             
         print('Done!\nInitiate learning procedure...')
         # найдем количество положительных примеров в выборке
         n_positive = np.sum(y.astype('int'))
         # найдем количество отрицательных примеров в выборке
         n_negative = len(y) - n_positive
-        # инициализируем веса
-        w = (1.0 / float(n_positive)) * y.astype('float') + (1.0 / float(n_negative)) * (y == 0).astype('float')
+        if state is None:
+            state = {}
+        if 'w' not in state:
+            # инициализируем веса
+            state['w'] = (1.0 / float(n_positive)) * y.astype('float') + (1.0 / float(n_negative)) * (y == 0).astype('float')
+        if 'rng' not in state:
+            state['rng'] = np.random.default_rng(self.random_state)
+        w, rng = state['w'], state['rng']
         print('Done!\nWill train the classifier...')
+        try:
+            for round in range(state.get('round', 0), self.rounds):
+                print("Раунд {}".format(round))
+                # нормируем веса так, чтобы сумма была равна 1
+                w /= np.sum(w)
+                # найдём лучший слабый классификатор (возможно, на части примеров и признаков)
+                keep, rows = self._round_subset(w, X.shape[1], rng)
+                weak_classifier, error, ftr_idx, weak_classifier_predictions = learn(y, w, keep, rows)
+                if keep is not None:
+                    # ошибка выбранного классификатора -- по всей выборке
+                    error = np.sum(w[weak_classifier_predictions != y])
+                print("Взвешенная ошибка текущего слабого классификатора: {}".format(error))
+                # если ошибка уже почти нулевая, остановимся
+                if error < self.eps:
+                    break
+                
+                # найдем beta
+                beta = error / (1.0 - error)
+                # e[i] == 0 если классификация правильная и 1 наоборот
+                e  = (y != weak_classifier_predictions).astype('float')
+                ne = 1.0 - e
+                # каждый правильно классифицированный вес нужно домножить на beta 
+                w *= (e + beta*ne)#np.power(beta, 1.0 - e)
+                state['round'] = round + 1
+                
+                yield weak_classifier, math.log(1.0 / beta), ftr_idx, weak_classifier_predictions
+                
+        finally:
+            if search is not None:
+                search.close()
+    
+    def _round_subset(self, w, n_features, rng):
+        '''
+        Подмножества примеров и признаков для поиска пня на очередном раунде
+        
+        На выходе:
+            keep -- bool маска примеров: отбрасываются самые легкие примеры, в сумме
+                    имеющие не больше trim_weight от общего веса (None -- все примеры)
+            rows -- случайные feature_fraction признаков (None -- все признаки)
+        '''
+        keep = None
+        if self.trim_weight > 0:
+            ws = np.sort(w)[::-1]
+            cum = np.cumsum(ws)
+            cut = ws[min(np.searchsorted(cum, (1.0 - self.trim_weight) * cum[-1]), len(ws) - 1)]
+            keep = w >= cut
+            if np.all(keep):
+                keep = None
+            else:
+                print("Примеров для поиска: {}".format(np.sum(keep)))
+        
+        rows = None
+        if self.feature_fraction < 1:
+            n = max(1, int(round(self.feature_fraction * n_features)))
+            rows = np.sort(rng.choice(n_features, n, replace = False))
+        
+        return keep, rows
+    
+    def _warm_state(self, X, y, classifiers, alpha, ftr_idxs):
+        '''
+        Состояние бустинга после уже обученных слабых классификаторов: веса примеров
+        восстанавливаются по их предсказаниям (beta = exp(-alpha)); случайные
+        подмножества признаков (feature_fraction) выбираются заново
+        '''
+        n_positive = np.sum(y.astype('int'))
+        n_negative = len(y) - n_positive
+        w = (1.0 / float(n_positive)) * y.astype('float') + (1.0 / float(n_negative)) * (y == 0).astype('float')
+        scores = np.zeros(len(y))
+        for classifier, weight, ftr_idx in zip(classifiers, alpha, ftr_idxs):
+            predictions = classifier.classify(np.asarray(X[:, ftr_idx]))
+            w /= np.sum(w)
+            w *= np.where(predictions != y, 1.0, math.exp(-weight))
+            scores += weight * predictions
+        return {'round': len(classifiers), 'w': w, 'rng': np.random.default_rng(self.random_state)}, scores
+    
+    def checkpoint_stamp(self, X, y, stamp = None):
+        '''
+        Отпечаток обучающих данных для контрольных точек; stamp -- уже посчитанный
+        data_stamp(X), иначе он считается здесь (полный проход по X)
+        '''
+        if stamp is None:
+            stamp = data_stamp(X)
+        return np.append(stamp, zlib.crc32(np.asarray(y, np.float64).tobytes()))
+    
+    def save_checkpoint(self, stamp, state, classifiers, alpha, ftr_idxs, scores):
+        '''
+        Сохраняет состояние fit в checkpoint_dir/boost.npz (через временный файл,
+        чтобы прерванная запись не портила предыдущую контрольную точку)
+        
+        stamp -- checkpoint_stamp обучающих данных
+        '''
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        path = os.path.join(self.checkpoint_dir, 'boost.npz')
+        tmp_path = os.path.join(self.checkpoint_dir, 'boost.tmp.npz')
+        np.savez(tmp_path,
+                 stamp      = stamp,
+                 round      = state['round'],
+                 w          = state['w'],
+                 rng        = json.dumps(state['rng'].bit_generator.state),
+                 scores     = scores,
+                 thresholds = np.array([c.threshold for c in classifiers], np.float64),
+                 polarities = np.array([c.polarity for c in classifiers], np.float64),
+                 alphas     = np.array(alpha, np.float64),
+                 ftr_idxs   = np.array(ftr_idxs, np.int64))
+        os.replace(tmp_path, path)
+    
+    def load_checkpoint(self, stamp):
+        '''
+        Загружает состояние fit из checkpoint_dir/boost.npz, если оно получено на тех же
+        данных (stamp -- checkpoint_stamp(X, y))
+        
+        На выходе:
+            None или classifiers, alpha, ftr_idxs, scores, state
+        '''
+        if self.checkpoint_dir is None:
+            return None
+        path = os.path.join(self.checkpoint_dir, 'boost.npz')
+        if not os.path.isfile(path):
+            return None
+        with np.load(path, allow_pickle = False) as data:
+            if not np.array_equal(data['stamp'], stamp):
+                print("Checkpoint {} was made on other data, ignore it".format(path))
+                return None
+            classifiers = [DecisionStump(t, p) for t, p in zip(data['thresholds'].tolist(), data['polarities'].tolist())]
+            rng = np.random.default_rng()
+            rng.bit_generator.state = json.loads(str(data['rng']))
+            state = {'round': int(data['round']), 'w': data['w'].copy(), 'rng': rng}
+            return classifiers, data['alphas'].tolist(), data['ftr_idxs'].tolist(), data['scores'].copy(), state
+    
+    def fit(self, X, y, warm_start = False):
+        '''
+        На входе:
+            X -- двумерный numpy массив, X[i,j] == значение признака j для примера i
+            y -- одномерный numpy массив с классом объекта (0|1)
+            rounds -- максимальное количество раундов обучения
+            eps -- критерий останова (алгоритм останавливается, если новый классификатор имеет ошибку меньше eps)
+            warm_start -- дообучить self.cls (результат fit до add_features) до rounds раундов
+
+        На выходе:
+            классификатор типа BoostingClassifier
+            
+        Если задан checkpoint_dir, каждые checkpoint_every раундов (и в конце) состояние
+        сохраняется на диск, и повторный вызов на тех же данных продолжает обучение с
+        последней контрольной точки (в том числе с увеличенным rounds).
+        '''
+        # найдем количество положительных и отрицательных примеров в выборке
+        n_positive = np.sum(y.astype('int'))
+        n_negative = len(y) - n_positive
+        
         classifiers = []
         ftr_idxs = []
         alpha = []
-        for round in range(0, self.rounds):
-            print("Раунд {}".format(round))
-            # нормируем веса так, чтобы сумма была равна 1
-            w /= np.sum(w)
-            # найдём лучший слабый классификатор
-            weak_classifier, error, ftr_idx, weak_classifier_predictions = ViolaJonesСlassifier.learn_best_classifier(DecisionStump, X_t, y, w, indices)
-            print("Взвешенная ошибка текущего слабого классификатора: {}".format(error))
-            # если ошибка уже почти нулевая, остановимся
-            if error < self.eps:
-                break
-            
-            # найдем beta
-            beta = error / (1.0 - error)
-            # e[i] == 0 если классификация правильная и 1 наоборот
-            e  = (y != weak_classifier_predictions).astype('float')
-            ne = 1.0 - e
-            # каждый правильно классифицированный вес нужно домножить на beta 
-            w *= (e + beta*ne)#np.power(beta, 1.0 - e)
+        # взвешенные суммы слабых классификаторов для каждого примера
+        scores = np.zeros(len(y))
+        state = {}
+        
+        # один проход по X и для контрольной точки, и для предсортировки на диске
+        stamp = None if self.presort_path() is None else data_stamp(X)
+        checkpoint_stamp = None if self.checkpoint_dir is None else self.checkpoint_stamp(X, y, stamp)
+        checkpoint = self.load_checkpoint(checkpoint_stamp)
+        if checkpoint is not None:
+            classifiers, alpha, ftr_idxs, scores, state = checkpoint
+            print("Resume from round {}".format(state['round']))
+        elif warm_start and self.cls is not None:
+            if not isinstance(self.cls, BoostingClassifier):
+                raise ValueError("warm_start needs a BoostingClassifier trained by fit (before add_features)")
+            classifiers, alpha, ftr_idxs = list(self.cls.classifiers), list(self.cls.weights), list(self.cls.ftr_idxs)
+            state, scores = self._warm_state(X, y, classifiers, alpha, ftr_idxs)
+        
+        for weak_classifier, weight, ftr_idx, weak_predictions in self.boost(X, y, state, stamp):
             # добавим к ансамблю новый классификатор с его весом и признаком
             classifiers.append(weak_classifier)
             ftr_idxs.append(ftr_idx)
-            alpha.append(math.log(1.0 / beta))
+            alpha.append(weight)
             
-            # посчитаем промежуточную точность
-            strong_classifier = BoostingClassifier(classifiers, alpha, ftr_idxs)
-            predictions = np.array([strong_classifier.classify(X[i]) for i in range(0, len(X))])
+            # посчитаем промежуточную точность: достаточно добавить к суммам
+            # предсказания нового классификатора
+            scores += weight * weak_predictions
+            predictions = (scores > sum(alpha) / 2).astype(int)
             
             pos_predictions = np.sum((predictions * y).astype('float'))
             neg_predictions = np.sum((predictions * (1 - y)).astype('float'))
@@ -490,9 +2195,112 @@ class ViolaJonesСlassifier(object):
             print("Correct detected faces {}".format(correct_positives))
             print("Correct detected non-faces {}".format(correct_negatives))
             
+            if self.checkpoint_dir is not None and state['round'] % self.checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_stamp, state, classifiers, alpha, ftr_idxs, scores)
+            
+        if self.checkpoint_dir is not None and 'round' in state:
+            self.save_checkpoint(checkpoint_stamp, state, classifiers, alpha, ftr_idxs, scores)
         print('Done!')
         
         self.cls = BoostingClassifier(classifiers, alpha, ftr_idxs)
+    
+    def fit_stage(self, X, y, detection_rate = 0.99, fp_rate = 0.5):
+        '''
+        Обучение одной ступени каскада: слабые классификаторы добавляются,
+        пока доля ложных срабатываний не опустится до fp_rate (но не более self.rounds раундов).
+        Порог ступени подбирается так, чтобы доля найденных лиц была не меньше detection_rate.
+        
+        На входе:
+            X, y -- как у fit
+            
+        На выходе:
+            stage    -- BoostingClassifier с подобранным порогом
+            stage_fp -- доля ложных срабатываний ступени на обучающих отрицательных примерах
+        '''
+        pos = (y == 1)
+        n_keep = int(math.ceil(detection_rate * np.sum(pos)))
+        
+        classifiers = []
+        ftr_idxs = []
+        alpha = []
+        scores = np.zeros(len(y))
+        
+        stage, stage_fp = None, 1.0
+        rounds = self.boost(X, y)
+        try:
+            for weak_classifier, weight, ftr_idx, predictions in rounds:
+                classifiers.append(weak_classifier)
+                ftr_idxs.append(ftr_idx)
+                alpha.append(weight)
+                scores += weight * predictions
+                
+                # максимальный порог, при котором проходит n_keep положительных примеров
+                pos_scores = np.sort(scores[pos])[::-1]
+                threshold = np.nextafter(pos_scores[max(n_keep, 1) - 1], -np.inf)
+                stage_fp = np.mean(scores[~pos] > threshold)
+                
+                stage = BoostingClassifier(list(classifiers), list(alpha), list(ftr_idxs), threshold)
+                print("Ступень: {} признаков, ложных срабатываний {}".format(len(classifiers), stage_fp))
+                if stage_fp <= fp_rate:
+                    break
+        finally:
+            rounds.close()
+        
+        return stage, stage_fp
+    
+    def fit_cascade(self, X_pos, X_neg, detection_rate = 0.99, fp_rate = 0.5,
+                    target_fp_rate = 1e-3, max_stages = 20, n_negatives = None, mine_negatives = None):
+        '''
+        Обучение каскада
+        
+        На входе:
+            X_pos, X_neg   -- признаки положительных и отрицательных примеров (пул отрицательных)
+            detection_rate -- минимальная доля найденных лиц для каждой ступени
+            fp_rate        -- максимальная доля ложных срабатываний для каждой ступени
+            target_fp_rate -- общая доля ложных срабатываний, после которой обучение останавливается
+            max_stages     -- максимальное количество ступеней
+            n_negatives    -- сколько отрицательных примеров брать на ступень (по умолчанию len(X_pos))
+            mine_negatives -- функция (cascade, n) -> признаки не более n новых отрицательных
+                              примеров, принимаемых каскадом (см. mine_hard_negatives); вызывается,
+                              когда в пуле остается меньше n_negatives примеров
+            
+        Каждая ступень обучается на отрицательных примерах, прошедших все предыдущие ступени.
+        '''
+        if n_negatives is None:
+            n_negatives = len(X_pos)
+        
+        cascade = CascadeClassifier([])
+        total_fp = 1.0
+        neg = X_neg
+        for stage_ind in range(max_stages):
+            if total_fp <= target_fp_rate:
+                break
+            # оставим отрицательные примеры, которые каскад еще не отверг
+            if cascade.stages:
+                neg = neg[cascade.stages[-1].classify_batch(neg) == 1]
+                if mine_negatives is not None and len(neg) < n_negatives:
+                    # пополним пул ложными срабатываниями текущего каскада
+                    mined = mine_negatives(cascade, n_negatives - len(neg))
+                    neg = np.concatenate((neg, mined))
+            if len(neg) == 0:
+                break
+            
+            print("Ступень {}, отрицательных примеров: {}".format(stage_ind, len(neg)))
+            neg_s = neg[:n_negatives]
+            X = np.concatenate((X_pos, neg_s))
+            y = np.concatenate((np.ones(len(X_pos)), np.zeros(len(neg_s))))
+            
+            stage, stage_fp = self.fit_stage(X, y, detection_rate, fp_rate)
+            if stage is None:
+                break
+            
+            cascade.stages.append(stage)
+            total_fp *= stage_fp
+            print("Оценка доли ложных срабатываний каскада: {}".format(total_fp))
+        
+        print('Done!')
+        
+        self.cls = cascade
         
     def add_features(self, features):
         '''
@@ -504,90 +2312,602 @@ class ViolaJonesСlassifier(object):
         '''        
         self.ftrs = [features[i] for i in self.cls.ftr_idxs]
         self.cls.ftr_idxs = list(range(0,len(self.ftrs)))
+        # Для работы храним пни в numpy массивах
+        self.cls = self.cls.compile()
+        self._operator = None
+        self._offsets = {}
+        self._scaled = {}
+        self._stage_features = {}
+        
+    def soft_cascade(self, img_pos):
+        '''
+        Переводит классификатор (каждую ступень каскада) в режим раннего отказа,
+        пороги отказа подбираются по окнам с лицами img_pos (вызываем после calibrate)
+        '''
+        F = self.compute_wlist_features(img_pos)
+        if isinstance(self.cls, CascadeClassifier):
+            self.cls = CascadeClassifier([stage.compile().soft_cascade(F) for stage in self.cls.stages])
+        else:
+            self.cls = self.cls.compile().soft_cascade(F)
+        self._stage_features = {}
+        
+    # Версия формата файла модели (2 -- пороги раннего отказа)
+    MODEL_FORMAT_VERSION = 2
+    
+    def save_model(self, path):
+        '''
+        Сохраняет обученный детектор (после add_features) в npz файл:
+        прямоугольники признаков, параметры пней, веса и пороги ступеней
+        '''
+        stages = self._stages()
+        np.savez(path,
+                 format_version   = self.MODEL_FORMAT_VERSION,
+                 img_sz           = self.img_sz,
+                 is_cascade       = isinstance(self.cls, CascadeClassifier),
+                 feature_types    = np.array([HAAR_FEATURE_TYPES.index(type(f)) for f in self.ftrs], np.int32),
+                 feature_geometry = np.array([f.geometry() for f in self.ftrs], np.int32).reshape(-1, 4),
+                 stage_lengths    = np.array([len(stage.weights) for stage in stages], np.int64),
+                 stage_thresholds = np.array([stage.threshold for stage in stages], np.float64),
+                 stage_soft       = np.array([stage.compile().rejection is not None for stage in stages], bool),
+                 rejection        = np.concatenate([np.zeros(len(stage.weights)) if stage.compile().rejection is None
+                                                    else stage.compile().rejection for stage in stages]),
+                 thresholds       = np.concatenate([stage.compile().thresholds for stage in stages]),
+                 polarities       = np.concatenate([stage.compile().polarities for stage in stages]),
+                 alphas           = np.concatenate([stage.compile().alphas     for stage in stages]),
+                 ftr_idxs         = np.concatenate([stage.compile().ftr_idxs   for stage in stages]))
+    
+    @staticmethod
+    def load_model(path):
+        '''
+        Загружает детектор, сохраненный save_model; классификатор сразу
+        получается в виде CompiledBoostingClassifier (или каскада из них)
+        '''
+        with np.load(path, allow_pickle = False) as data:
+            version = int(data['format_version'])
+            if version not in (1, ViolaJonesСlassifier.MODEL_FORMAT_VERSION):
+                raise ValueError("Unsupported model format version: {}".format(version))
+            # в версии 1 порогов раннего отказа нет
+            stage_soft = data['stage_soft'] if version >= 2 else np.zeros(len(data['stage_lengths']), bool)
+            
+            ret = ViolaJonesСlassifier(int(data['img_sz']))
+            ret.ftrs = [HAAR_FEATURE_TYPES[t](*g) for t, g in zip(data['feature_types'], data['feature_geometry'].tolist())]
+            
+            stages = []
+            start = 0
+            for length, threshold, soft in zip(data['stage_lengths'], data['stage_thresholds'], stage_soft):
+                stop = start + length
+                stages.append(CompiledBoostingClassifier(data['thresholds'][start:stop],
+                                                         data['polarities'][start:stop],
+                                                         data['alphas'][start:stop],
+                                                         data['ftr_idxs'][start:stop],
+                                                         float(threshold),
+                                                         data['rejection'][start:stop] if soft else None))
+                start = stop
+            
+            ret.cls = CascadeClassifier(stages) if bool(data['is_cascade']) else stages[0]
+        return ret
         
     def classify_win(self, window, ret_qa = False):
-        return self.cls.classify(compute_features_for_image(IntegralImage(window), self.ftrs), ret_qa)
+        # Признаки считаются лениво, чтобы каскад не считал признаки отвергнутых окон
+        return self.cls.classify(LazyFeatures(IntegralImage(window), self.ftrs), ret_qa)
 
+    def feature_operator(self):
+        '''
+        HaarFeatureOperator для признаков self.ftrs (кешируется)
+        '''
+        if getattr(self, '_operator', None) is None:
+            self._operator = HaarFeatureOperator(self.ftrs, self.img_sz)
+        return self._operator
+    
+    def compute_wlist_features(self, wlist, chunk_size = 1024):
+        '''
+        Значения признаков self.ftrs для списка окон img_sz x img_sz
+        
+        На выходе:
+            двумерный numpy массив (len(wlist), len(self.ftrs))
+        '''
+        operator = self.feature_operator()
+        F = np.zeros((len(wlist), len(self.ftrs)))
+        for start in range(0, len(wlist), chunk_size):
+            chunk = np.array(wlist[start : start + chunk_size], np.float64)
+            F[start : start + len(chunk)] = operator.compute(IntegralImageStack(chunk))
+        return F
+    
     def classify_wlist(self, wlist, ret_qa = False):
-        return [self.classify_win(win, ret_qa) for win in wlist]
+        if len(wlist) == 0:
+            return []
+        res = self.cls.classify_batch(self.compute_wlist_features(wlist), ret_qa)
+        if ret_qa:
+            return list(zip(*res))
+        else:
+            return list(res)
         
-    def calibrate(self, img_pos, img_neg, rate = 0.5, N = 20):
-            
-        pivot_thr = 0.5*sum(self.cls.weights)
-
-        thr     = []
-        fls_pos = []
+    def _calibration_scores(self, wlist):
+        '''
+        Суммы слабых классификаторов калибруемой (последней) ступени для окон;
+        окна, отвергнутые предыдущими ступенями каскада, получают -inf
+        '''
+        F = self.compute_wlist_features(wlist)
+        scores = np.full(len(F), -np.inf)
+        if isinstance(self.cls, CascadeClassifier):
+            passed = CascadeClassifier(self.cls.stages[:-1]).classify_batch(F) == 1
+            scores[passed] = self.cls.stages[-1].score_batch(F[passed])
+        else:
+            scores[:] = self.cls.score_batch(F)
+        return scores
+    
+    def calibrate(self, img_pos, img_neg, detection_rate = 0.9):
+        '''
+        Подбор порога: минимальная доля ложных срабатываний на img_neg
+        при доле найденных лиц на img_pos больше detection_rate
         
-        bar = progressbar.ProgressBar()
-        for i in bar(range(0, N + 1)):
-            
-            # Не хочется делать полный брутфорс
-            cur_thr = pivot_thr * (1 + rate * (i / N - 0.5))
-            
-            self.cls.threshold = cur_thr
-            
-            pred_pos = self.classify_wlist(img_pos)
-            detection_rate = sum(pred_pos) / len(pred_pos)
-      
-            if detection_rate > 0.9:
-                pred_neg = self.classify_wlist(img_neg)
-                false_positive_rate = sum(pred_neg) / len(pred_neg)
-                fls_pos.append(false_positive_rate)
-                thr.append(cur_thr)
+        Каждое окно классифицируется один раз, дальше перебираются все пороги
+        между соседними значениями сумм (вся ROC кривая). Порог должен быть
+        положительным (иначе qa = res / threshold теряет смысл); если ни один такой
+        порог не дает нужной доли найденных лиц, порог не меняется.
+        '''
+        # У каскада калибруем порог последней ступени
+        cls = self.cls.stages[-1] if isinstance(self.cls, CascadeClassifier) else self.cls
+        
+        pos = np.sort(self._calibration_scores(img_pos))
+        neg = np.sort(self._calibration_scores(img_neg))
+        
+        # Кандидаты в пороги: ниже минимальной суммы и посередине между соседними суммами
+        # (суммы неотрицательны, поэтому "ниже минимальной" -- ее половина)
+        values = np.unique(np.concatenate((pos, neg)))
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            print("Nothing to calibrate: all windows are rejected")
+            return
+        thr = np.concatenate(([0.5 * values[0]], 0.5 * (values[:-1] + values[1:])))
+        
+        # Классификатор принимает окно, если сумма больше порога
+        detected = 1.0 - np.searchsorted(pos, thr, 'right') / len(pos)
+        fls_pos  = 1.0 - np.searchsorted(neg, thr, 'right') / len(neg)
         
-        i = np.array(fls_pos).argmin()
+        ok = np.nonzero((detected > detection_rate) & (thr > 0))[0]
+        if len(ok) == 0:
+            print("Warning: no positive threshold gives detection rate above {}, keep threshold {}".format(
+                  detection_rate, cls.threshold))
+            return
+        # При равной доле ложных срабатываний берем больший порог
+        i = ok[len(ok) - 1 - np.argmin(fls_pos[ok][::-1])]
+        print("Detection rate(%): {}".format(detected[i] * 100))
         print("False positive rate(%): {}".format(fls_pos[i] * 100))
 
         # В конце установить подходящее значение порога
-        self.cls.threshold = thr[i]
+        cls.threshold = thr[i]
 
-    def detect_win(self, img, x, xc, y, yc):
+    def _window_offsets(self, h, w):
+        '''
+        Значения признаков на единичном окне h x w, приведенном к img_sz x img_sz
+        
+        resize линеен, поэтому признак нормированного окна равен
+        (признак окна - mean * признак единичного окна) / std
+        '''
+        cache = self.__dict__.setdefault('_offsets', {})
+        if (h, w) not in cache:
+            ones = resize(np.ones((h, w)), (self.img_sz, self.img_sz), mode='constant', clip=False)
+            cache[(h, w)] = compute_features_for_image(IntegralImage(ones), self.ftrs)
+        return cache[(h, w)]
+    
+    def detect_win(self, img, x, xc, y, yc, frame = None):
+        '''
+        На входе:
+            img          -- изображение
+            x, xc, y, yc -- границы окна img[x:xc, y:yc]
+            frame        -- FrameIntegrals для img; если задан, среднее и отклонение окна
+                            берутся из него, а не отдельным проходом по окну
+        '''
         img_sz = self.img_sz
-        crop = img[x:xc,y:yc]
-        crop = normalize_image(crop)
-        crop = resize(crop, (img_sz, img_sz), mode='constant').astype(np.float32)
-        return self.classify_win(crop, ret_qa = True)
+        crop = np.asarray(img[x:xc,y:yc], np.float64)
+        if frame is None:
+            mean, std = crop.mean(), crop.std()
+        else:
+            mean, std = frame.window_stats(x, xc, y, yc)
+        # clip=False: без обрезки по диапазону resize линеен (у нормированного окна
+        # диапазон содержит 0, и обрезка ничего не меняет)
+        crop = resize(crop, (img_sz, img_sz), mode='constant', clip=False)
+        # Нормировку окна переносим на значения признаков
+        features = LazyFeatures(IntegralImage(crop), self.ftrs,
+                                mean * self._window_offsets(xc - x, yc - y),
+                                0.0 if std == 0 else 1.0 / std)
+        return self.cls.classify(features, ret_qa = True)
 
-    def detect_multi(self, image, step = 1):
+    def scaled_features(self, size):
+        '''
+        Признаки self.ftrs, масштабированные под окно size x size (кешируются)
+        '''
+        cache = self.__dict__.setdefault('_scaled', {})
+        if size not in cache:
+            cache[size] = ScaledFeatures(self.ftrs, self.img_sz, size)
+        return cache[size]
+    
+    def detect_win_scaled(self, frame, x, y, size):
+        '''
+        То же, что detect_win, но без приведения окна к img_sz x img_sz:
+        масштабированные признаки считаются прямо по интегральному изображению кадра
+        
+        На входе:
+            frame -- FrameIntegrals кадра
+            x, y  -- левый верхний угол окна
+            size  -- размер окна
+        '''
+        mean, std = frame.window_stats(x, x + size, y, y + size)
+        features = ScaledWindowFeatures(self.scaled_features(size), frame.integral, x, y, mean, std)
+        return self.cls.classify(features, ret_qa = True)
+
+    def _stages(self):
+        return self.cls.stages if isinstance(self.cls, CascadeClassifier) else [self.cls]
+    
+    def _scaled_stages(self, size):
+        '''
+        Для каждой ступени -- масштабированные признаки ее слабых классификаторов (по порядку)
+        '''
+        cache = self.__dict__.setdefault('_stage_features', {})
+        if size not in cache:
+            sf = self.scaled_features(size)
+            # у ступеней с ранним отказом -- отдельно для каждого блока
+            cache[size] = [[((start, stop), sf.take(stage.ftr_idxs[start:stop])) for start, stop in stage.blocks()]
+                           for stage in self._stages()]
+        return cache[size]
+    
+    def score_windows(self, frame, size, x, y, chunk_size = 1 << 22):
+        '''
+        Классификация сразу множества окон одного размера
+        
+        На входе:
+            frame      -- FrameIntegrals кадра
+            size       -- размер окон
+            x, y       -- одномерные numpy массивы левых верхних углов окон
+            chunk_size -- ограничение на количество элементов выборки углов за раз
+            
+        На выходе:
+            is_face -- bool массив, окно принято классификатором
+            qa      -- качество (res / threshold) последней вычисленной для окна ступени
+        '''
+        x = np.asarray(x, np.intp)
+        y = np.asarray(y, np.intp)
+        mean, std = frame.window_stats(x, x + size, y, y + size)
+        
+        is_face = np.ones(len(x), bool)
+        qa      = np.zeros(len(x))
+        alive   = np.arange(len(x))
+        for stage, blocks in zip(self._stages(), self._scaled_stages(size)):
+            if len(alive) == 0:
+                break
+            # Отвергнутые предыдущими ступенями окна дальше не считаем
+            res = np.zeros(len(alive))
+            # live -- номера (в alive) окон, еще не отвергнутых досрочно внутри ступени
+            live = np.arange(len(alive))
+            for (start, stop), sf in blocks:
+                if len(live) == 0:
+                    break
+                rejected = np.zeros(len(live), bool)
+                chunk = max(1, chunk_size // max(1, len(sf.cx)))
+                for a in range(0, len(live), chunk):
+                    sub = live[a : a + chunk]
+                    ids = alive[sub]
+                    F = sf.normalize(sf.values(frame.integral, x[ids], y[ids]), mean[ids], std[ids])
+                    res[sub], rejected[a : a + chunk] = stage.score_block(F, start, stop, res[sub])
+                live = live[~rejected]
+            passed = res > stage.threshold
+            qa[alive] = res / stage.threshold
+            is_face[alive] = passed
+            alive = alive[passed]
+        
+        return is_face, qa
+    
+    def detect_map(self, frame, size, step = 1):
+        '''
+        Плотная карта классификации окон size x size по сетке с шагом step
+        
+        На выходе:
+            gx, gy  -- координаты узлов сетки (x и y левого верхнего угла окна)
+            is_face -- bool карта (len(gx), len(gy))
+            qa      -- карта качества (len(gx), len(gy))
+        '''
+        w, h = frame.shape
+        # Обрабатывем только допустимые окна: x + size < w, y + size < h
+        gx = np.arange(0, max(w - size, 0), step)
+        gy = np.arange(0, max(h - size, 0), step)
+        x, y = np.meshgrid(gx, gy, indexing = 'ij')
+        is_face, qa = self.score_windows(frame, size, x.ravel(), y.ravel())
+        return gx, gy, is_face.reshape(x.shape), qa.reshape(x.shape)
+
+    def detect_tile(self, frame, size, step, x0, x1, y0, y1):
+        '''
+        Поиск лиц размера size, у которых узел "грубой" сетки лежит в [x0, x1) x [y0, y1)
+        
+        Уточняющий обход с шагом в 1 пиксель может выйти за границы плитки
+        (на step пикселей), поэтому одно окно может найтись в соседних плитках.
+        
+        На выходе:
+            xs, ys, qa -- левые верхние углы найденных окон (без повторов) и их качество
+        '''
+        w, h = frame.shape
+        # Изображение обходим с "грубым" шагом
+        gx = np.arange(0, max(w - size, 0), step)
+        gy = np.arange(0, max(h - size, 0), step)
+        gx = gx[(gx >= x0) & (gx < x1)]
+        gy = gy[(gy >= y0) & (gy < y1)]
+        x, y = np.meshgrid(gx, gy, indexing = 'ij')
+        return self.detect_nodes(frame, size, step, x.ravel(), y.ravel())
+    
+    def detect_nodes(self, frame, size, step, x, y):
+        '''
+        Поиск лиц размера size по заданным узлам "грубой" сетки с шагом step
+        
+        На входе:
+            x, y -- одномерные numpy массивы узлов (левых верхних углов окон)
+            
+        На выходе:
+            xs, ys, qa -- как у detect_tile
+        '''
+        w, h = frame.shape
+        is_face, _ = self.score_windows(frame, size, x, y)
+        hx, hy = x[is_face], y[is_face]
+        #Если нашли лицо - обходим прилегающую область с шагом в 1 пиксель
+        offsets = np.arange(-step, step)
+        xs = (hx[:, None, None] + offsets[None, :, None]) + 0 * offsets[None, None, :]
+        ys = (hy[:, None, None] + offsets[None, None, :]) + 0 * offsets[None, :, None]
+        #Обрабатываем только валиные окна, каждое - один раз
+        valid = (xs > 0) & (ys > 0) & (xs + size < w) & (ys + size < h)
+        windows = np.unique(xs[valid] * h + ys[valid])
+        xs, ys = windows // h, windows % h
+        
+        is_face, qa = self.score_windows(frame, size, xs, ys)
+        return xs[is_face], ys[is_face], qa[is_face]
+
+    def detect_multi(self, image, step = 1, n_jobs = 1, tile_size = 256, backend = 'thread'):
+        '''
+        На входе:
+            image     -- изображение
+            step      -- шаг "грубого" обхода
+            n_jobs    -- количество потоков/процессов; при n_jobs > 1 кадр разбивается
+                         на независимые задания (масштаб, плитка tile_size x tile_size)
+            backend   -- 'thread' (потоки работают с общим кадром) или 'process'
+                         (интегральные изображения кадра кладутся в разделяемую память)
+            
+        На выходе:
+            для каждого масштаба -- список рамок (x, y, xc, yc, qa), упорядоченный по (x, y)
+        '''
         w, h = image.shape
+        # Интегральные изображения кадра строим один раз
+        frame = FrameIntegrals(image)
         d = min(w, h)
         # лучше задавать не абсолютные размеры окна, а относительные (в процентах)
         window_sizes = [0.1, 0.2, 0.4, 0.8]
+        sizes = [int(d * w_size) for w_size in window_sizes]
+        
+        jobs = []
+        for scale, size in enumerate(sizes):
+            if size < 1:
+                continue
+            # Масштабированные признаки готовим заранее, до запуска заданий
+            self._scaled_stages(size)
+            if n_jobs > 1:
+                for x0 in range(0, w, tile_size):
+                    for y0 in range(0, h, tile_size):
+                        jobs.append((scale, size, x0, x0 + tile_size, y0, y0 + tile_size))
+            else:
+                jobs.append((scale, size, 0, w, 0, h))
+        
+        bar = progressbar.ProgressBar(maxval = len(jobs))
+        if n_jobs > 1 and backend == 'process':
+            found = list(bar(_detect_in_processes(self, frame, step, jobs, n_jobs)))
+        elif n_jobs > 1:
+            with ThreadPoolExecutor(n_jobs) as pool:
+                found = list(bar(pool.map(lambda job: self.detect_tile(frame, job[1], step, *job[2:]), jobs)))
+        else:
+            found = [self.detect_tile(frame, job[1], step, *job[2:]) for job in bar(jobs)]
+        
+        # Собираем результаты плиток: окна, найденные в соседних плитках, оставляем один раз
         results = []
-        for w_size in window_sizes:
-            res_scaled = []
-            bar = progressbar.ProgressBar()
-            # Изображение обходим с "грубым" шагом
-            for x in bar(range(0, w, step)):
-                xc = x + int(d * w_size)
-                for y in range(0, h, step):
-                    yc = y + int(d * w_size) # - пропорции лица по ширине/высоте
-                    # Обрабатывем только допустимые окна
-                    if xc < w and yc < h:
-                        is_face, face_qa = self.detect_win(image, x, xc, y, yc)
-                        if is_face:
-                            #Если нашли лицо - обходим прилегающую область с шагом в 1 пиксель
-                            for sx in range(-step, step):
-                                xs = x + sx
-                                xe = x + sx + int(d * w_size)
-                                for sy in range(-step, step):
-                                    ys = y + sy
-                                    ye = y + sy+ int(d * w_size)
-                                    if xs < w and ys < h and xe < w and ye < h and xs > 0 and ys > 0 and xe > 0 and ye > 0:
-                                        #Обрабатываем только валиные окна
-                                        is_face, face_qa = self.detect_win(image, xs, xe, ys, ye)
-                                        if is_face:
-                                            #Формируем список найденных рамок
-                                            res_scaled.append((xs, ys, xe, ye, face_qa))
-                            
-            results.append(res_scaled)
+        for scale, size in enumerate(sizes):
+            parts = [res for job, res in zip(jobs, found) if job[0] == scale]
+            if not parts:
+                results.append([])
+                continue
+            xs = np.concatenate([p[0] for p in parts])
+            ys = np.concatenate([p[1] for p in parts])
+            qa = np.concatenate([p[2] for p in parts])
+            windows, first = np.unique(xs * h + ys, return_index = True)
+            #Формируем список найденных рамок
+            results.append([(int(x), int(y), int(x) + size, int(y) + size, q)
+                            for x, y, q in zip(windows // h, windows % h, qa[first])])
         #
         return results
     
-    def detect(self, image, step = 1):
-        
+    def detect(self, image, step = 1, iou_thr = None, min_neighbors = 3, n_jobs = 1, backend = 'thread'):
+        '''
+        На входе:
+            image         -- изображение
+            step          -- шаг "грубого" обхода
+            n_jobs, backend -- параллельный поиск (см. detect_multi)
+            iou_thr       -- если задан, рамки всех масштабов группируются (group_detections)
+            min_neighbors -- минимальный размер группы
+            
+        На выходе:
+            список рамок (x, y, xc, yc, qa)
+        '''
         ret = []
-        for res in self.detect_multi(image, step):
+        for res in self.detect_multi(image, step, n_jobs = n_jobs, backend = backend):
             ret += res
         
+        if iou_thr is not None:
+            ret = group_detections(ret, iou_thr, min_neighbors)
+        
         return ret
+    
+    def detect_video(self, frames, step = 1, **kwargs):
+        '''
+        Генератор: для каждого кадра frames -- сгруппированные рамки (x, y, xc, yc, qa)
+        (kwargs -- параметры VideoDetector)
+        '''
+        tracker = VideoDetector(self, step, **kwargs)
+        for image in frames:
+            yield tracker.detect(image)
+    
+    def false_positive_windows(self, images, step = 4, scale_factor = 1.25, max_per_image = None, rng = None):
+        '''
+        Генератор окон, которые детектор принимает на изображениях без лиц
+        
+        На входе:
+            images        -- изображения без лиц
+            step          -- шаг обхода
+            scale_factor  -- отношение соседних размеров окна (от img_sz до размера изображения)
+            max_per_image -- ограничение на количество окон с одного изображения и масштаба
+            rng           -- numpy.random.Generator; изображения и найденные окна обходятся
+                             в случайном порядке
+            
+        На выходе (по одному):
+            окна, нормированные и приведенные к img_sz x img_sz, как в prepare_negatives
+        '''
+        if rng is None:
+            rng = np.random.default_rng()
+        
+        for ind in rng.permutation(len(images)):
+            image = images[ind]
+            frame = FrameIntegrals(image)
+            w, h = frame.shape
+            size = self.img_sz
+            while size < min(w, h):
+                # Окна сканируем быстрым путем, кропы делаем только для принятых
+                _, _, is_face, _ = self.detect_map(frame, size, step)
+                gx = np.arange(0, max(w - size, 0), step)
+                gy = np.arange(0, max(h - size, 0), step)
+                hx, hy = np.nonzero(is_face)
+                found = rng.permutation(len(hx))[:max_per_image]
+                for x, y in zip(gx[hx[found]], gy[hy[found]]):
+                    crop = normalize_image(np.asarray(image[x : x + size, y : y + size], np.float64))
+                    yield resize(crop, (self.img_sz, self.img_sz), mode='constant')
+                size = max(size + 1, int(size * scale_factor))
+    
+    def mine_hard_negatives(self, images, n_negatives, features, cls = None, chunk_size = 256, **kwargs):
+        '''
+        Сбор ложных срабатываний для обучения (bootstrap): вызываем до add_features
+        
+        На входе:
+            images      -- изображения без лиц
+            n_negatives -- максимальное количество собираемых окон
+            features    -- все признаки, на которых обучается классификатор
+            cls         -- классификатор с индексами признаков из features (по умолчанию self.cls)
+            chunk_size  -- сколько окон обрабатывать за раз
+            kwargs      -- параметры false_positive_windows
+            
+        На выходе:
+            двумерный float32 numpy массив (<= n_negatives, len(features)) значений признаков окон
+        '''
+        # Копия классификатора, переведенная на свои признаки, не мешает обучению
+        detector = ViolaJonesСlassifier(self.img_sz)
+        detector.cls = copy.deepcopy(self.cls if cls is None else cls)
+        detector.add_features(features)
+        
+        operator = HaarFeatureOperator(features, self.img_sz)
+        windows = itertools.islice(detector.false_positive_windows(images, **kwargs), n_negatives)
+        
+        parts = []
+        bar = progressbar.ProgressBar(maxval = n_negatives)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(windows, chunk_size))
+            if not chunk:
+                break
+            parts.append(operator.compute(IntegralImageStack(np.array(chunk))).astype(np.float32))
+            count += len(chunk)
+            bar.update(count)
+        bar.finish()
+        
+        print("Найдено ложных срабатываний: {}".format(count))
+        if not parts:
+            return np.zeros((0, len(features)), np.float32)
+        return np.concatenate(parts)
+
+#==============================================================================
+# Поиск лиц на видео
+#
+# Между соседними кадрами лица смещаются на несколько пикселей, поэтому на
+# большинстве кадров достаточно просмотреть окрестности найденных рамок на
+# близких масштабах. Полный обход кадра делается раз в full_scan_every кадров
+# и когда число отслеживаемых лиц изменилось.
+
+class VideoDetector:
+    def __init__(self, detector, step = 1, full_scan_every = 25, dilation = 0.5,
+                 scale_factors = (0.8, 1.0, 1.25), iou_thr = 0.3, min_neighbors = 3,
+                 n_jobs = 1, backend = 'thread'):
+        '''
+        На входе:
+            detector        -- обученный ViolaJonesСlassifier
+            step            -- шаг "грубого" обхода
+            full_scan_every -- период полного обхода кадра
+            dilation        -- окрестность рамки, в которой ищется лицо (в долях размера рамки)
+            scale_factors   -- масштабы окна относительно размера рамки
+            iou_thr, min_neighbors -- параметры group_detections
+            n_jobs, backend -- параллельный полный обход (см. detect_multi)
+        '''
+        self.detector = detector
+        self.step = step
+        self.full_scan_every = full_scan_every
+        self.dilation = dilation
+        self.scale_factors = scale_factors
+        self.iou_thr = iou_thr
+        self.min_neighbors = min_neighbors
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.reset()
+    
+    def reset(self):
+        # отслеживаемые рамки и номер следующего кадра
+        self.tracks = []
+        self.n_frames = 0
+    
+    def _scan_tracks(self, frame):
+        '''
+        Поиск лиц только в окрестностях отслеживаемых рамок
+        '''
+        w, h = frame.shape
+        # для каждого размера окна -- объединение окрестностей на "грубой" сетке
+        nodes = {}
+        for x, y, xc, yc, _ in self.tracks:
+            size = int(round(((xc - x) + (yc - y)) / 2))
+            margin = max(self.step, int(self.dilation * size))
+            for factor in self.scale_factors:
+                sz = int(round(size * factor))
+                if sz < 1 or sz >= min(w, h):
+                    continue
+                if sz not in nodes:
+                    gx = np.arange(0, max(w - sz, 0), self.step)
+                    gy = np.arange(0, max(h - sz, 0), self.step)
+                    nodes[sz] = (gx, gy, np.zeros((len(gx), len(gy)), bool))
+                gx, gy, mask = nodes[sz]
+                mask[np.ix_((gx >= x - margin) & (gx <= x + margin),
+                            (gy >= y - margin) & (gy <= y + margin))] = True
+        
+        dets = []
+        for sz, (gx, gy, mask) in nodes.items():
+            ix, iy = np.nonzero(mask)
+            xs, ys, qa = self.detector.detect_nodes(frame, sz, self.step, gx[ix], gy[iy])
+            dets += [(int(x), int(y), int(x) + sz, int(y) + sz, q) for x, y, q in zip(xs, ys, qa)]
+        
+        return group_detections(dets, self.iou_thr, self.min_neighbors)
+    
+    def detect(self, image):
+        '''
+        На входе:
+            image -- очередной кадр
+            
+        На выходе:
+            список сгруппированных рамок (x, y, xc, yc, qa)
+        '''
+        full = (self.n_frames % self.full_scan_every == 0)
+        if not full:
+            dets = self._scan_tracks(FrameIntegrals(image))
+            full = (len(dets) != len(self.tracks))
+        if full:
+            dets = self.detector.detect(image, self.step, self.iou_thr, self.min_neighbors,
+                                        self.n_jobs, self.backend)
+        
+        self.tracks = dets
+        self.n_frames += 1
+        return dets
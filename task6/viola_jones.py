@@ -23,14 +23,15 @@ SOFTWARE.
 """
 
 #==============================================================================
-import pickle
-
 import numpy as np
 
 import os
 import os.path
 from os import walk
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import progressbar
 
 from skimage import io
@@ -43,32 +44,40 @@ import sys
 sys.path.append(os.getcwd())
 from libvj import *
 
-import random
-from random import randint
-
 
 
 #==============================================================================
-def _get_all_images(starting_dir):
-    images = []
+def _get_image_paths(starting_dir):
+    paths = []
     extensions = ["pgm", "jpeg", "jpg", "png"]
     for dir, _, filenames in walk(starting_dir):
         for filename in filenames:
             extension = os.path.splitext(filename)[1][1:]
             if extension in extensions:
-                image = io.imread(os.path.join(dir, filename))
-                images.append(image)
-    return images
+                paths.append(os.path.join(dir, filename))
+    return paths
+
+#==============================================================================
+def iter_images(paths, n_jobs = 8, prefetch = 64):
+    # Изображения декодируются в пуле потоков, но не больше prefetch штук
+    # впереди потребителя; порядок сохраняется
+    with ThreadPoolExecutor(n_jobs) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(io.imread, path))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 #==============================================================================
 def get_all_images(starting_dir, img_file):
-    
-    if os.path.isfile(img_file):
-        return np.load(img_file)
-    else:
-        ret = _get_all_images(starting_dir)
-        np.save(img_file, ret)
-        return ret
+    # Кеш -- плоский буфер пикселей и индекс (см. ImageStore), открывается через mmap
+    base = os.path.splitext(img_file)[0]
+    if not ImageStore.exists(base):
+        # пиксели пишутся на диск по мере чтения, весь набор в памяти не держим
+        return ImageStore.from_images(iter_images(_get_image_paths(starting_dir)), base)
+    return ImageStore.load(base)
 
 #==============================================================================
 # Препроцессинг изображений с лицами
@@ -86,22 +95,27 @@ def prepare_positives(images, result_l):
 # Препроцессинг изображений без лиц
 # 
 # * Вырежем случайные квадраты из негативных изображений
-# * Нормируем яркость
-# * Преобразуем к 24 * 24
+# * Нормируем яркость (каждого квадрата отдельно, как окна при поиске)
+# * Преобразуем к 24 * 24 (квадраты одного размера -- одним вызовом resize)
 
-def prepare_negatives(images, sample_size, result_l):
-    norm_images = [normalize_image(im.astype('float')) for im in images]
-    crops = []
-    for _ in range(0, sample_size):
-        image_ind = randint(0, len(norm_images) - 1)
-        image = norm_images[image_ind]
-        w, h = image.shape
-        max_r = min(w, h)
-        r = random.randint(result_l, max_r)
-        x, y = randint(0, w - max_r), randint(0, h - max_r)
-        crop = image[x: x + r, y: y + r]
-        crop = resize(crop, (result_l, result_l), mode='constant')
-        crops.append(crop)
+def prepare_negatives(images, sample_size, result_l, seed = None):
+    rng = np.random.default_rng(seed)
+    
+    # Сначала разыгрываем все квадраты: изображение, размер, положение
+    image_inds = rng.integers(0, len(images), sample_size)
+    shapes = np.array([images[i].shape[:2] for i in image_inds]).reshape(-1, 2)
+    rs = rng.integers(result_l, np.minimum(shapes[:, 0], shapes[:, 1]) + 1)
+    xs = rng.integers(0, shapes[:, 0] - rs + 1)
+    ys = rng.integers(0, shapes[:, 1] - rs + 1)
+    
+    crops = np.empty((sample_size, result_l, result_l), np.float32)
+    for r in np.unique(rs):
+        inds = np.nonzero(rs == r)[0]
+        batch = np.array([images[image_inds[i]][xs[i] : xs[i] + r, ys[i] : ys[i] + r] for i in inds], np.float64)
+        mean = batch.mean(axis = (1, 2), keepdims = True)
+        std = batch.std(axis = (1, 2), keepdims = True)
+        batch = np.where(std == 0, 0.0, (batch - mean) / np.where(std == 0, 1.0, std))
+        crops[inds] = resize(batch, (len(inds), result_l, result_l), mode='constant')
     return crops
 
 #==============================================================================
@@ -139,7 +153,7 @@ print('Preparing negative images...')
 if os.path.isfile(neg_prep_fl):
     negatives_prepared = np.load(neg_prep_fl)
 else:
-    negatives_prepared = prepare_negatives(negatives, n_negatives, image_canonical_size)
+    negatives_prepared = prepare_negatives(negatives, n_negatives, image_canonical_size, seed = 0)
     np.save(neg_prep_fl, negatives_prepared)
 print('Done!')
 
@@ -157,8 +171,8 @@ assert(all([image_has_correct_format(im) for im in negatives_prepared]))
 
 #==============================================================================
 print('Preparing integral images...')
-integral_positives = get_integral_imgs(positives_prepared, 'data/pos_int.npy') #[IntegralImage(im) for im in positives_prepared]
-integral_negatives = get_integral_imgs(negatives_prepared, 'data/neg_int.npy') #[IntegralImage(im) for im in negatives_prepared]
+integral_positives = get_integral_imgs(positives_prepared, 'data/pos_int.npy') #IntegralImageStack(positives_prepared)
+integral_negatives = get_integral_imgs(negatives_prepared, 'data/neg_int.npy') #IntegralImageStack(negatives_prepared)
 print('Done!')
 
 
@@ -189,40 +203,31 @@ for x in range(0, image_canonical_size, x_stride):
                         continue
 print("Всего признаков: {}".format(len(all_features)))  
 
-#==============================================================================
-def _compute_features(integral_images, features):
-    result = np.zeros((len(integral_images), len(features)))
-    bar = progressbar.ProgressBar(maxval = len(integral_images))
-    
-    bar.start()
-    for ind, integral_image in enumerate(bar(integral_images)):
-        result[ind] = compute_features_for_image(integral_image, features)
-        bar.update(ind+1)
-    return result
-
 #==============================================================================
 def compute_features(integral_images, features, ftr_file):
-    if os.path.isfile(ftr_file):    
-        return np.load(ftr_file)
-    else:
-        ret = _compute_features(integral_images, features)
-        np.save(ftr_file, ret)
-        return ret
+    # Все признаки компилируем один раз в разреженный оператор, дальше считаем
+    # их пачками изображений прямо в float32 файл, отображенный в память;
+    # прерванный расчет продолжается с первой непосчитанной пачки
+    operator = HaarFeatureOperator(features, image_canonical_size)
+    return compute_features_file(integral_images, operator, ftr_file, bar = progressbar.ProgressBar())
 
 #==============================================================================
+# Положительные и отрицательные примеры считаем в одну матрицу,
+# обучение читает ее с диска без загрузки целиком
+
 print('Will compute features...')
-positive_features = compute_features(integral_positives, all_features, 'data/pos.npy')
-negative_features = compute_features(integral_negatives, all_features, 'data/neg.npy')
+integral_train = IntegralImageStack.from_integral(np.concatenate((integral_positives.integral_images,
+                                                                  integral_negatives.integral_images)))
+X_train = compute_features(integral_train, all_features, 'data/train.npy')
 print('Done!')
 
 #==============================================================================
 # Подготовим тренировочный набор
 
 print('Will prepare train set...')
-y_positive = np.ones(len(positive_features))
-y_negative = np.zeros(len(negative_features))
+y_positive = np.ones(len(integral_positives))
+y_negative = np.zeros(len(integral_negatives))
     
-X_train = np.concatenate((positive_features, negative_features))
 y_train = np.concatenate((y_positive, y_negative))
 print('Done!')
 
@@ -230,23 +235,42 @@ print('Done!')
 
 print('Will get face detector!')
 
-fd_file = 'data/face_detector.pickle'
+fd_file = 'data/face_detector.npz'
 
 if os.path.isfile(fd_file):
     
     print('Loading...')        
-    vj_cls = pickle.load(open(fd_file,'rb'))
+    vj_cls = ViolaJonesСlassifier.load_model(fd_file)
 else:
     
     vj_cls = ViolaJonesСlassifier(image_canonical_size, rounds = 200)
     
-    print('Will train face detector...')
-    vj_cls.fit(X_train, y_train)
+    # Bootstrap: ложные срабатывания детектора на полноразмерных изображениях
+    # без лиц добавляем к обучающей выборке и обучаем детектор заново
+    n_bootstrap = 2
+    for bootstrap in range(n_bootstrap + 1):
+        # Контрольные точки: прерванное обучение продолжится с последней из них;
+        # у каждого прохода своя выборка, поэтому и свои контрольные точки
+        vj_cls.checkpoint_dir = os.path.join('data/checkpoint', 'pass{}'.format(bootstrap))
+        print('Will train face detector...')
+        vj_cls.fit(X_train, y_train)
+        if bootstrap == n_bootstrap:
+            break
+        
+        # Новая выборка -- тоже float32 файл, отображенный в память
+        train_file = 'data/train_pass{}.npy'.format(bootstrap + 1)
+        if not os.path.isfile(train_file):
+            print('Will mine hard negatives...')
+            hard_negatives = vj_cls.mine_hard_negatives(negatives, n_negatives, all_features,
+                                                        rng = np.random.default_rng(bootstrap))
+            concatenate_to_file([X_train, hard_negatives], train_file)
+        X_train = np.load(train_file, mmap_mode = 'r')
+        y_train = np.concatenate((y_train, np.zeros(len(X_train) - len(y_train))))
     print('Will optimize face detector...')
     vj_cls.add_features(all_features)
 
     print('Will check for false positive...')
-    negatives_prepared_new = prepare_negatives(negatives, 10000, image_canonical_size)
+    negatives_prepared_new = prepare_negatives(negatives, 10000, image_canonical_size, seed = 1)
     pred_neg_new = vj_cls.classify_wlist(negatives_prepared_new)
     false_positive_rate = sum(pred_neg_new) / len(pred_neg_new)
     print("Процент ложных обнаружений: {}".format(false_positive_rate * 100))
@@ -261,8 +285,11 @@ else:
     print('Will calibrate face detector...')
     vj_cls.calibrate(test_prepared, negatives_prepared_new)    
     
+    print('Will enable early rejection...')
+    vj_cls.soft_cascade(positives_prepared)
+    
     print('Will save the face detector...')
-    pickle.dump(vj_cls, open(fd_file,'wb'))
+    vj_cls.save_model(fd_file)
     
 print('Done!')
 
@@ -271,7 +298,8 @@ print('Done!')
 images_to_scan = get_all_images('data/for_scanning', 'data/for_scan_img.npy')
 #==============================================================================
 
-result = vj_cls.detect(images_to_scan[0], 8)
+# Близкие рамки группируем, чтобы на каждое лицо осталась одна
+result = vj_cls.detect(images_to_scan[0], 8, iou_thr = 0.3, min_neighbors = 3)
 
 np.save('detected_frames.npy', np.array(result))
 